@@ -2,6 +2,29 @@ import os
 
 from utils.utils import *
 from utils.bearing import *
+from utils.graph_store import write_graph
+
+
+def add_edge_bearing(cities, path_data):
+    """
+    add edge attribute "bearing" to the original graphs of the cities and store them as graph stores
+    :param cities: list of cities (01_Vienna, 02_Mexico, 03_Djibouti)
+    :param path_data: data folder (01_Data)
+    :return:
+    """
+    for city in cities:
+        path_orig = os.path.join(path_data, '01_Original', city)
+        path_graph = os.path.join(path_orig, [f for f in os.listdir(path_orig) if 'nx_graph' in f and 'with_bearing' not in f][0])
+
+        # read graph as NetworkGraph
+        graph = NetworkGraph(path_graph)
+
+        # add additional edge bearing attributes to graph
+        graph = compute_bearing_attributes(graph)
+
+        # store graph with bearing attributes
+        path_out = os.path.join(path_orig, '{:s}_nx_graph_with_ec_with_bearing.graph'.format(city[3:].lower()))
+        write_graph(graph.graph, path_out)
 
 
 if __name__ == '__main__':
@@ -15,16 +38,4 @@ if __name__ == '__main__':
 
     cities = ['01_Vienna', '02_Mexico', '03_Djibouti']
 
-    for city in cities:
-        path_orig = os.path.join(path_data, '01_Original', city)
-        path_graph = os.path.join(path_orig, [f for f in os.listdir(path_orig) if 'nx_graph' in f][0])
-
-        # read graph as NetworkGraph
-        graph = NetworkGraph(path_graph)
-
-        # add additional edge bearing attributes to graph
-        graph = compute_bearing_attributes(graph)
-
-        # store graph with bearing attributes
-        path_out = os.path.join(path_orig, '{:s}_nx_graph_with_ec_with_bearing.p'.format(city[3:].lower()))
-        nx.write_gpickle(graph.graph, path_out)
+    add_edge_bearing(cities, path_data)
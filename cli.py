@@ -0,0 +1,149 @@
+import os
+import time
+import argparse
+import importlib
+
+# one entry point for all scripts: python cli.py <command> [arguments] (see python cli.py -h)
+# only the module of the selected command is imported (heavy libraries are imported inside the functions using them),
+# import time and run time are reported
+
+CITIES = ['01_Vienna', '02_Mexico', '03_Djibouti']
+SIZES = ['boundingbox', 'subgraphs', 'subgraphs_oneshot', 'big', 'medium', 'small', 'extents']
+EXTENTS = ['big', 'medium', 'small']
+
+
+def timed_import(name):
+    """
+    :param name: module name
+    :return: imported module (import time printed)
+    """
+    t0 = time.perf_counter()
+    module = importlib.import_module(name)
+    print('import {:s}: {:.2f} s'.format(name, time.perf_counter() - t0))
+    return module
+
+
+def radius_argument(radius):
+    # single radius or list of radii (as in preprocessing.py)
+    return radius[0] if len(radius) == 1 else radius
+
+
+def threshold_argument(value):
+    # node ratio threshold of area extent, e.g. medium=1.346
+    extent, thresh = value.split('=')
+    if extent not in EXTENTS:
+        raise argparse.ArgumentTypeError('unknown area extent {:s}'.format(extent))
+    return extent, float(thresh)
+
+
+def extent_argument(value):
+    # area extent or extent of a threshold sweep (clipping extents --thresholds), e.g. ratio_1.300
+    if value not in EXTENTS and not value.startswith('ratio_'):
+        raise argparse.ArgumentTypeError('unknown area extent {:s}'.format(value))
+    return value
+
+
+def bearing(args):
+    timed_import('add_edge_bearing').add_edge_bearing(args.cities, args.data)
+
+
+def clipping(args):
+    timed_import('preprocessing').preprocessing(args.city, 'clipping', args.size, args.data, extents=args.thresholds)
+
+
+def centralities(args):
+    timed_import('preprocessing').preprocessing(args.city, 'centralities', None, args.data,
+                                                radius=radius_argument(args.radius), reuse_city=args.reuse_city)
+
+
+def taken_nodes(args):
+    timed_import('taken_nodes').taken_nodes(args.city, args.data)
+
+
+def thresholds(args):
+    timed_import('taken_nodes_analysis').taken_nodes_analysis(args.city, args.data)
+
+
+def properties(args):
+    size = args.size[0] if len(args.size) == 1 else args.size
+    timed_import('streetnetworkproperties').street_network_properties(args.city, size, args.data)
+
+
+def regression(args):
+    timed_import('regression').regression(args.cities, args.size, args.data)
+
+
+def pipeline(args):
+    timed_import('pipeline').run_pipeline(args.city, args.data, radius=radius_argument(args.radius),
+                                          thresholds=dict(args.threshold), only=args.only, force=args.force,
+                                          oneshot=args.oneshot)
+
+
+def parser():
+    p = argparse.ArgumentParser(description='street network properties and success of wayfinding simulations')
+    p.add_argument('--data', default=os.path.join(os.path.normpath(os.getcwd() + os.sep + os.pardir), '01_Data'),
+                   help='data folder (default ../01_Data)')
+    sub = p.add_subparsers(dest='command', required=True)
+
+    s = sub.add_parser('bearing', help='add edge attribute "bearing" to the original graphs')
+    s.add_argument('--cities', nargs='+', choices=CITIES, default=CITIES)
+    s.set_defaults(run=bearing)
+
+    s = sub.add_parser('clipping', help='clip subgraphs of all routes')
+    s.add_argument('city', choices=CITIES)
+    s.add_argument('size', choices=SIZES)
+    s.add_argument('--thresholds', nargs='+', type=float, default=None,
+                   help='node ratio thresholds of size extents (default big, medium, small)')
+    s.set_defaults(run=clipping)
+
+    s = sub.add_parser('centralities', help='local centralities of all subgraphs')
+    s.add_argument('city', choices=CITIES)
+    s.add_argument('--radius', nargs='+', type=int, default=[800], help='radius or radii [m] (default 800)')
+    s.add_argument('--reuse-city', action='store_true', help='reuse local centralities of the whole city graph')
+    s.set_defaults(run=centralities)
+
+    s = sub.add_parser('taken-nodes', help='node ratios of all taken nodes of the simulation datasets')
+    s.add_argument('--city', choices=CITIES, default='01_Vienna')
+    s.set_defaults(run=taken_nodes)
+
+    s = sub.add_parser('thresholds', help='node ratio thresholds of the area extents (taken node analysis)')
+    s.add_argument('--city', choices=CITIES, default='01_Vienna')
+    s.set_defaults(run=thresholds)
+
+    s = sub.add_parser('properties', help='street network properties of all routes')
+    s.add_argument('city', choices=CITIES)
+    s.add_argument('size', nargs='+', type=extent_argument,
+                   help='area extent (big, medium, small, ratio_<threshold>) or nested extents (computed in one task)')
+    s.set_defaults(run=properties)
+
+    s = sub.add_parser('regression', help='principal component regression')
+    s.add_argument('size', type=extent_argument, help='area extent (big, medium, small, ratio_<threshold>)')
+    s.add_argument('--cities', nargs='+', choices=CITIES, default=['01_Vienna'])
+    s.set_defaults(run=regression)
+
+    s = sub.add_parser('pipeline', help='run all stale stages of the pipeline of a city')
+    s.add_argument('city', choices=CITIES)
+    s.add_argument('--radius', nargs='+', type=int, default=[800], help='radius or radii [m] (default 800)')
+    s.add_argument('--threshold', nargs='*', type=threshold_argument, default=[],
+                   help='node ratio thresholds, e.g. medium=1.346 (default EXTENT_THRESHOLDS)')
+    s.add_argument('--only', nargs='+', default=None, help='stage names to run (default all)')
+    s.add_argument('--force', action='store_true', help='recompute all routes')
+    s.add_argument('--oneshot', action='store_true', help='clip the subgraphs in one step (no boundingbox graphs)')
+    s.set_defaults(run=pipeline)
+    return p
+
+
+if __name__ == '__main__':
+    '''
+    - command line interface of all scripts, e.g.
+      python cli.py clipping 01_Vienna medium
+      python cli.py clipping 01_Vienna extents --thresholds 1.1 1.2 1.3 1.4 1.5
+      python cli.py properties 01_Vienna ratio_1.100 ratio_1.200 ratio_1.300 ratio_1.400 ratio_1.500
+      python cli.py centralities 01_Vienna --radius 400 800
+      python cli.py pipeline 01_Vienna --only clipping_medium properties_medium
+    '''
+
+    args = parser().parse_args()
+    t1 = time.time()
+    args.run(args)
+    print(args.command, '{:.2f} min'.format((time.time() - t1) / 60))
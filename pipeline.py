@@ -0,0 +1,44 @@
+from utils.pipeline import *
+
+
+def run_pipeline(city, path_data, radius=800, thresholds=None, only=None, force=False, oneshot=False):
+    """
+    run all stale stages of the pipeline of a city
+    :param city: city (01_Vienna, 02_Mexico, 03_Djibouti)
+    :param path_data: data folder (01_Data)
+    :param radius: radius for local centrality computation (or list of radii)
+    :param thresholds: node ratio thresholds of area extents (default EXTENT_THRESHOLDS)
+    :param only: None (all stages) or list of stage names
+    :param force: True to recompute all routes
+    :param oneshot: True to clip the subgraphs in one step (no boundingbox graphs)
+    :return: dict {stage name: list of recomputed route ids} (RuntimeError if a route failed)
+    """
+    pipeline = Pipeline(city, path_data, stages(radius=radius, thresholds=thresholds, oneshot=oneshot),
+                        routeids=range(100))
+    return pipeline.run(only=only, force=force)
+
+
+if __name__ == '__main__':
+    '''
+    - script to run the whole preprocessing and analysis pipeline of one city
+    - stages: clipping boundingbox -> subgraphs -> centralities -> big/medium/small -> properties -> regression
+    - only stale routes are recomputed (changed inputs or parameters, missing outputs)
+
+    -> select city
+    -> select parameters (radius, node ratio thresholds)
+    '''
+
+    #####################################################
+    path_data = os.path.join(os.path.normpath(os.getcwd() + os.sep + os.pardir), '01_Data')
+
+    # ARGUMENTS TO SET
+    # ------------------------------------------------------------------------------------#
+    city = '01_Vienna'  # 01_Vienna, 02_Mexico, 03_Djibouti
+    radius = 800  # radius for local centrality computation (or list of radii, e.g. [400, 800, 1200, 1600])
+    thresholds = {'big': 1.5, 'medium': 1.346, 'small': 1.203}  # node ratio thresholds of area extents
+    only = None  # None (all stages) or list of stage names, e.g. ['clipping_medium', 'properties_medium']
+    force = False  # True to recompute all routes
+    oneshot = False  # True to clip the subgraphs in one step (no boundingbox graphs)
+    # ------------------------------------------------------------------------------------#
+
+    run_pipeline(city, path_data, radius=radius, thresholds=thresholds, only=only, force=force, oneshot=oneshot)
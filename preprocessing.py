@@ -1,6 +1,62 @@
 import multiprocessing as mp
 
 from utils.processing import *
+from utils.centrality import radius_list, valid_centrality_cache
+from utils.workers import init_worker
+from utils.graph_store import find_graph
+
+
+def preprocessing(city, function, size, path_data, radius=800, reuse_city=False, extents=None):
+    """
+    clipping of subgraphs or local centrality computation of all routes of a city
+    :param city: city (01_Vienna, 02_Mexico, 03_Djibouti)
+    :param function: clipping, centralities
+    :param size: None, boundingbox, subgraphs, subgraphs_oneshot (boundingbox and subgraphs in one step), big, medium,
+    small, extents (several area extents in one task per route)
+    :param path_data: data folder (01_Data)
+    :param radius: radius for local centrality computation (or list of radii, e.g. [400, 800, 1200, 1600])
+    :param reuse_city: True to compute local centralities of the whole city graph once and reuse them for all
+    subgraphs (only nodes near the boundary of a subgraph are recomputed)
+    :param extents: area extents of size extents, dict {area extent: node ratio threshold} (default big, medium,
+    small) or list of node ratio thresholds (stored as ratio_<threshold>)
+    :return:
+    """
+    path_orig = os.path.join(path_data, '01_Original', city)
+    path_sub = os.path.join(path_data, '02_Subgraphs', city)
+    path_graph = find_graph(path_orig, 'nx_graph_with_ec_with_bearing')
+    path_routes = os.path.join(path_orig, [f for f in os.listdir(path_orig) if 'random_routes' in f][0])
+
+    # route ids (graph and routes are only loaded by the workers)
+    ids = list(range(100))
+
+    radii = '_'.join(str(r) for r in radius_list(radius))
+    path_cache = os.path.join(path_sub, 'city_centralities_{:s}.npz'.format(radii))
+
+    # multiprocessing: graph and routes loaded once per worker, tasks only carry route ids
+    if function == 'clipping':
+        pool = mp.Pool(int(mp.cpu_count() - 1), initializer=init_worker, initargs=(path_graph, path_routes))
+    else:
+        pool = mp.Pool(int(mp.cpu_count() - 1))
+
+    if function == 'clipping' and size == 'extents':
+        # all area extents of a route in one task (node ratios and subgraph read once)
+        pool.starmap_async(graph_clipping_extents, [(r, city, None, None, path_sub, extents) for r in ids]).get()
+    elif function == 'clipping':
+        # batches of routes, one task per batch
+        batches = [[int(r) for r in b] for b in np.array_split(ids, int(mp.cpu_count() - 1)) if len(b) > 0]
+        pool.starmap_async(graph_clipping_batch, [(b, city, None, None, path_sub, size) for b in batches]).get()
+    elif function == 'centralities':
+        # city-wide values recomputed if missing or computed from another graph, radii or code (fingerprint)
+        if reuse_city and not valid_centrality_cache(path_cache, cache_fingerprint(path_graph, radius)):
+            city_centrality_computation(path_graph, radius, path_cache, pool, int(mp.cpu_count() - 1))
+
+        # source nodes of each subgraph split into shards, largest subgraphs first
+        sharded_centrality_computation(ids, city, path_sub, radius, pool, int(mp.cpu_count() - 1),
+                                       path_cache=path_cache if reuse_city else None)
+    else:
+        print('Please set the variable function to a valid input (clipping or centralities).')
+    pool.close()
+    pool.join()
 
 
 if __name__ == '__main__':
@@ -20,28 +76,17 @@ if __name__ == '__main__':
     # ------------------------------------------------------------------------------------#
     city = '03_Djibouti'    # 01_Vienna, 02_Mexico, 03_Djibouti
     function = 'clipping'  # clipping, centralities
-    size = 'small'         # None, boundingbox, subgraphs, big, medium, small
+    size = 'small'         # None, boundingbox, subgraphs, subgraphs_oneshot, big, medium, small, extents
     # ------------------------------------------------------------------------------------#
 
-    path_orig = os.path.join(path_data, '01_Original', city)
-    path_sub = os.path.join(path_data, '02_Subgraphs', city)
-    path_graph = os.path.join(path_orig, [f for f in os.listdir(path_orig) if 'nx_graph_with_ec_with_bearing' in f][0])
-    path_routes = os.path.join(path_orig, [f for f in os.listdir(path_orig) if 'random_routes' in f][0])
-
-    # routes, graph and ids
-    routes = nx.read_gpickle(path_routes)
-    graph = NetworkGraph(path_graph)
-    ids = list(range(100))
-
-    # radius for local centrality computation
+    # radius for local centrality computation (or list of radii, e.g. [400, 800, 1200, 1600])
     radius = 800
 
-    # multiprocessing: one route per node
-    pool = mp.Pool(int(mp.cpu_count() - 1))
+    # local centralities of the whole city graph computed once and reused for all subgraphs
+    # (only nodes near the boundary of a subgraph are recomputed)
+    reuse_city = False
 
-    if function == 'clipping':
-        pool.starmap_async(graph_clipping, [(id, city, graph, routes, path_sub, size) for id in ids]).get()
-    elif function == 'centralities':
-        pool.starmap_async(local_centrality_computation, [(id, city, path_sub, radius) for id in ids]).get()
-    else:
-        print('Please set the variable function to a valid input (clipping or centralities).')
\ No newline at end of file
+    # area extents clipped in one task per route (size extents), e.g. [1.1, 1.15, 1.2, ...] for a sensitivity analysis
+    extents = {'big': 1.5, 'medium': 1.346, 'small': 1.203}
+
+    preprocessing(city, function, size, path_data, radius=radius, reuse_city=reuse_city, extents=extents)
@@ -1,14 +1,16 @@
 import os
-import statsmodels.formula.api as smf
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
-from sklearn.decomposition import _factor_analysis as fa
-from scipy import stats
 
 from utils.utils import *
 
 
-def principal_component_regression(prop):
+def principal_component_regression(prop, city, size, path_data):
+    # statistics libraries imported here (slow imports, not needed by the other scripts and workers)
+    import statsmodels.formula.api as smf
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.decomposition import PCA
+    from sklearn.decomposition import _factor_analysis as fa
+    from scipy import stats
+
     # selected 30 street network properties
     cols = ['area', 'length', 'intersection_density_a', 'street_density', 'graph_density', 'mean_node_degree',
             'mean_segment_length', 'deadend_perc', 'mean_deadend_length', 'detour_to_mean_segment_ratio',
@@ -99,33 +101,18 @@ def principal_component_regression(prop):
         print(ft, ' {:.3f}'.format(stats.pearsonr(prop[ft], prop.success_perc)[0]))
 
 
-if __name__ == '__main__':
-    '''
-    - script to compute regression models
-    
-    -> select city or cities
-    -> select area extent
-    '''
-
-    #####################################################
-    path_data = os.path.join(os.path.normpath(os.getcwd() + os.sep + os.pardir), '01_Data')
-
-    # ARGUMENTS TO SET
-    # ------------------------------------------------------------------------------------#
-    cities = ['01_Vienna']  # 01_Vienna or 02_Mexico or 03_Djibouti or all 3
-    size = 'big'  # big, medium, small
-    # ------------------------------------------------------------------------------------#
-
+def regression_data(cities, size, path_data):
+    """
+    street network properties of all routes of the selected cities with success percentage of the simulations
+    :param cities: list of cities (01_Vienna, 02_Mexico, 03_Djibouti)
+    :param size: area extent (big, medium, small, ratio_<threshold>)
+    :param path_data: data folder (01_Data)
+    :return: dataframe (NaN dropped)
+    """
     properties = pd.DataFrame()
-    path_out = os.path.join(path_data, '03_StreetNetworkProperties')
-
     for city in cities:
-        path_orig = os.path.join(path_data, '01_Original', city)
         path_properties = os.path.join(path_data, '03_StreetNetworkProperties', size)
         files = [f for f in os.listdir(path_properties) if city[3:].lower() in f]
-        datasets = ['vienna_3000_agents_and_100_routes_our_approach_vienna_best_perc.csv',
-                    'mexico_3000_agents_and_100_routes_our_approach_vienna_best_perc.csv',
-                    'djibouti_3000_agents_and_100_routes_our_approach_mexico_best_perc.csv']
 
         # street network properties
         properties_c = pd.DataFrame()
@@ -135,14 +122,55 @@ if __name__ == '__main__':
             properties_c = pd.concat((properties_c, result), ignore_index=True)
 
         # success percentage of simulations
-        dataset_ix = 0 if city == '01_Vienna' else 1 if city == '02_Mexico' else 2 if city == '03_Djibouti' else 999
-        data = AgentData(os.path.join(path_orig, datasets[dataset_ix]))
+        data = AgentData(regression_dataset(path_data, city), cache=os.path.join(path_data, '.agentdata_cache', city))
         success = data.success_per_route().percentage
 
         properties = pd.concat((properties, pd.concat((properties_c, success.rename('success_perc')), axis=1)))
 
     # clean data (drop NaN)
-    properties = properties.dropna().reset_index(drop=True)
+    return properties.dropna().reset_index(drop=True)
+
+
+def regression_dataset(path_data, city):
+    """
+    :return: path of simulation dataset used for the success percentage of city
+    """
+    datasets = {'01_Vienna': 'vienna_3000_agents_and_100_routes_our_approach_vienna_best_perc.csv',
+                '02_Mexico': 'mexico_3000_agents_and_100_routes_our_approach_vienna_best_perc.csv',
+                '03_Djibouti': 'djibouti_3000_agents_and_100_routes_our_approach_mexico_best_perc.csv'}
+    return os.path.join(path_data, '01_Original', city, datasets[city])
+
+
+def regression(cities, size, path_data):
+    """
+    principal component regression of the street network properties of the cities (results printed)
+    :param cities: list of cities (01_Vienna, 02_Mexico, 03_Djibouti)
+    :param size: area extent (big, medium, small, ratio_<threshold>)
+    :param path_data: data folder (01_Data)
+    :return:
+    """
+    # street network properties and success percentage of all selected cities
+    properties = regression_data(cities, size, path_data)
 
     # principal component regression
-    principal_component_regression(properties)
+    principal_component_regression(properties, cities[-1], size, path_data)
+
+
+if __name__ == '__main__':
+    '''
+    - script to compute regression models
+    
+    -> select city or cities
+    -> select area extent
+    '''
+
+    #####################################################
+    path_data = os.path.join(os.path.normpath(os.getcwd() + os.sep + os.pardir), '01_Data')
+
+    # ARGUMENTS TO SET
+    # ------------------------------------------------------------------------------------#
+    cities = ['01_Vienna']  # 01_Vienna or 02_Mexico or 03_Djibouti or all 3
+    size = 'big'  # big, medium, small
+    # ------------------------------------------------------------------------------------#
+
+    regression(cities, size, path_data)
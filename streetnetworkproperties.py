@@ -4,30 +4,104 @@ import multiprocessing as mp
 
 from utils.utils import *
 from utils.graph_indices import *
+from utils.workers import init_worker, worker_routes
+from utils.graph_store import read_polygon
 
 
-def network_properties(routeid, city, extent, path, routes):
+def network_properties(routeid, city, extent, path, routes=None):
     print(routeid)
     id = routeid
 
+    # routes loaded once per worker (init_worker) if not given
+    routes = worker_routes() if routes is None else routes
+
     t1 = time.time()
     path_sub = os.path.join(path, '02_Subgraphs', city)
     path_res = os.path.join(path, '03_StreetNetworkProperties', extent)
 
     # read clipped graph of selected area extent
-    graph = NetworkGraph(os.path.join(path_sub, extent, '{:s}_nx_graph_{:02d}.p'.format(city[3:].lower(), routeid)))
+    graph = NetworkGraph(os.path.join(path_sub, extent, '{:s}_nx_graph_{:02d}.graph'.format(city[3:].lower(), routeid)))
 
     # read convex hull polygon shape
-    polygon = nx.read_gpickle(os.path.join(path_sub, extent, '{:s}_polygon_{:02d}.p'.format(city[3:].lower(), routeid)))
+    polygon = read_polygon(os.path.join(path_sub, extent, '{:s}_polygon_{:02d}.wkb'.format(city[3:].lower(), routeid)))
 
     # feature/property computation for defined area
     features = indices(routeid, graph, polygon, routes[routeid])
 
     # store features as csv
+    os.makedirs(path_res, exist_ok=True)
     features.to_csv(os.path.join(path_res, '{:s}_properties_{:02d}.csv'.format(city[3:].lower(), routeid)), index=False)
     print(id, '{:.2f} min'.format((time.time() - t1) / 60))
 
 
+def network_properties_extents(routeid, city, extents, path, routes=None):
+    """
+    street network properties of several nested area extents of a route in one task: the largest extent is loaded
+    once, the other extents are induced subgraphs of it (its nodes inside their polygons), arrays and incidence
+    bearings of the nodes are shared, properties stored per extent as by network_properties
+    :param routeid: route id
+    :param city: city (01_Vienna, 02_Mexico, 03_Djibouti)
+    :param extents: list of area extents (e.g. big, medium, small)
+    :param path: data folder (01_Data)
+    :param routes: routes, None to use the routes loaded once per worker (init_worker)
+    :return:
+    """
+    print(routeid, extents)
+    routes = worker_routes() if routes is None else routes
+
+    t1 = time.time()
+    path_sub = os.path.join(path, '02_Subgraphs', city)
+    polygons = {e: read_polygon(os.path.join(path_sub, e, '{:s}_polygon_{:02d}.wkb'.format(city[3:].lower(), routeid)))
+                for e in extents}
+
+    # read clipped graph of the largest area extent
+    largest = max(extents, key=lambda e: polygons[e].area)
+    graph = NetworkGraph(os.path.join(path_sub, largest,
+                                      '{:s}_nx_graph_{:02d}.graph'.format(city[3:].lower(), routeid)))
+
+    for extent in extents:
+        # nodes of smaller extents: nodes of the largest extent inside their polygon (as graph_clipping)
+        if extent == largest:
+            g = graph
+        else:
+            mask = np.zeros(len(graph.compact), dtype=bool)
+            mask[graph.node_index.query_polygon(polygons[extent])] = True
+            g = graph.subgraph(mask)
+
+        # feature/property computation for defined area, stored as csv
+        features = indices(routeid, g, polygons[extent], routes[routeid])
+        path_res = os.path.join(path, '03_StreetNetworkProperties', extent)
+        os.makedirs(path_res, exist_ok=True)
+        features.to_csv(os.path.join(path_res, '{:s}_properties_{:02d}.csv'.format(city[3:].lower(), routeid)),
+                        index=False)
+    print(routeid, '{:.2f} min'.format((time.time() - t1) / 60))
+
+
+def street_network_properties(city, size, path_data):
+    """
+    street network properties of all routes of a city for one area extent or several nested area extents
+    :param city: city (01_Vienna, 02_Mexico, 03_Djibouti)
+    :param size: area extent (big, medium, small, ratio_<threshold> of clipping extents) or list of area extents
+    (one task per route)
+    :param path_data: data folder (01_Data)
+    :return:
+    """
+    path_orig = os.path.join(path_data, '01_Original', city)
+    path_routes = os.path.join(path_orig, [f for f in os.listdir(path_orig) if 'random_routes' in f][0])
+
+    # route ids (routes loaded once per worker)
+    routeIDs = list(range(100))
+
+    # compute street network properties, tasks only carry route ids
+    pool = mp.Pool(int(mp.cpu_count() - 2), initializer=init_worker, initargs=(None, path_routes))
+    if isinstance(size, list):
+        pool.starmap_async(network_properties_extents, [(r, city, size, path_data) for r in routeIDs]).get()
+    else:
+        pool.starmap_async(network_properties, [(r, city, size, path_data) for r in routeIDs]).get()
+    pool.close()
+    pool.join()
+
+
 if __name__ == '__main__':
     '''
     - script to extract street network properties
@@ -42,21 +116,7 @@ if __name__ == '__main__':
     # ARGUMENTS TO SET
     # ------------------------------------------------------------------------------------#
     city = '01_Vienna'  # 01_Vienna, 02_Mexico, 03_Djibouti
-    size = 'big'  # big, medium, small
+    size = 'big'  # big, medium, small or list of nested extents, e.g. ['big', 'medium', 'small'] (loaded once)
     # ------------------------------------------------------------------------------------#
 
-    path_orig = os.path.join(path_data, '01_Original', city)
-    path_graph = os.path.join(path_orig, [f for f in os.listdir(path_orig) if 'nx_graph_with_ec_with_bearing' in f][0])
-    path_routes = os.path.join(path_orig, [f for f in os.listdir(path_orig) if 'random_routes' in f][0])
-    files = [f for f in os.listdir(path_orig) if 'our_approach' in f]
-
-    # routes, graph and ids
-    routes = nx.read_gpickle(path_routes)
-    graph = NetworkGraph(path_graph)
-    routeIDs = list(range(100))
-
-    # compute street network properties
-    pool = mp.Pool(int(mp.cpu_count() - 2))
-    pool.starmap_async(network_properties, [(r, city, size, path_data, routes) for r in routeIDs]).get()
-    pool.close()
-    pool.join()
+    street_network_properties(city, size, path_data)
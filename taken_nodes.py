@@ -3,12 +3,19 @@ import time
 import multiprocessing as mp
 
 from utils.utils import *
+from utils.workers import init_worker, worker_graph, worker_routes, worker_data
+from utils.graph_store import find_graph
 
 
 def process(file, data, routeid, graph, routes, path):
     print(file, routeid)
     t0 = time.time()
 
+    # data, graph and routes loaded once per worker (init_worker) if not given
+    data = worker_data(file) if data is None else data
+    graph = worker_graph() if graph is None else graph
+    routes = worker_routes() if routes is None else routes
+
     # shortest path
     sp = routes[routeid]
     sp_nodes = graph.get_nodes_of_route(sp)
@@ -18,22 +25,25 @@ def process(file, data, routeid, graph, routes, path):
     nodeset = pd.read_csv(os.path.join(path, 'node_ratios', 'route_{:02d}.csv'.format(routeid)))
     nodeset['l'] = nodeset['l'] / sp_length
 
-    nodeset_tot = pd.DataFrame(columns=['id', 'x', 'y', 'l'])
-
-    for a in range(3000):
-        suc = data.data.success[(data.data.route_id == routeid) & (data.data.agent_id == a)].iloc[0]
-        dat = data.get_filtered_data(agent=a, route=routeid)
-
-        edges = dat.path_taken_edges.apply(eval)
-        nodes = graph.get_nodes_of_route(edges[0])
-
-        nodelist = pd.DataFrame.from_dict(nodes)
-        nodelist['agent_id'] = a
-        nodelist['route_id'] = routeid
-        nodelist['success'] = suc
-        nodelist = pd.merge(nodelist, nodeset[['id', 'l']], on=['id'])
-
-        nodeset_tot = pd.concat([nodeset_tot, nodelist], ignore_index=True)
+    # all taken nodes of all agents (0 - 2999) of route in one array
+    rows, nodes = data.route_nodes(routeid)
+    agents = data.data.agent_id.to_numpy()[rows]
+    rows, nodes, agents = rows[agents < 3000], nodes[agents < 3000], agents[agents < 3000]
+
+    # node ratio of taken nodes, lookup in node_ratios table (nodes not in table are dropped)
+    order = np.argsort(nodeset.id.to_numpy(), kind='stable')
+    ids_sorted = nodeset.id.to_numpy()[order]
+    pos = np.clip(np.searchsorted(ids_sorted, nodes), 0, max(len(ids_sorted) - 1, 0))
+    found = ids_sorted[pos] == nodes if len(ids_sorted) != 0 else np.zeros(len(nodes), dtype=bool)
+    ix = graph.node_index.lookup(nodes[found])
+
+    nodeset_tot = pd.DataFrame({'id': nodes[found],
+                                'x': graph.node_index.x[ix],
+                                'y': graph.node_index.y[ix],
+                                'l': nodeset.l.to_numpy()[order[pos[found]]],
+                                'agent_id': agents[found],
+                                'route_id': routeid,
+                                'success': data.data.success.to_numpy()[rows[found]]})
 
     name = file[-30:-4]
     if 'perc' in name:
@@ -50,6 +60,34 @@ def process(file, data, routeid, graph, routes, path):
 
     print('Route ID: {:02d}, Time: {:.2f}'.format(routeid, time.time() - t0))
 
+
+def taken_nodes(city, path_data):
+    """
+    node ratios of all taken nodes of all simulation datasets of a city
+    :param city: city (01_Vienna, 02_Mexico, 03_Djibouti)
+    :param path_data: data folder (01_Data)
+    :return:
+    """
+    path_orig = os.path.join(path_data, '01_Original', city)
+    path_sub = os.path.join(path_data, '02_Subgraphs', city)
+    path_graph = find_graph(path_orig, 'nx_graph_with_ec_with_bearing')
+    path_routes = os.path.join(path_orig, [f for f in os.listdir(path_orig) if 'random_routes' in f][0])
+    files = [f for f in os.listdir(path_orig) if 'our_approach' in f and f.endswith('.csv')]
+
+    routeIDs = list(range(100))
+
+    # agent data parsed once, parsed edge lists (sidecar outside of the input folder) are memory-mapped by all workers
+    path_cache = os.path.join(path_data, '.agentdata_cache', city)
+    paths_data = {f: AgentData(os.path.join(path_orig, f), cache=path_cache).cache_path for f in files}
+
+    # graph (without edge geometries, only node coordinates and edge lengths needed), routes and agent data loaded once
+    # per worker, tasks only carry file names and route ids
+    pool = mp.Pool(mp.cpu_count() - 1, initializer=init_worker, initargs=(path_graph, path_routes, paths_data, False))
+    pool.starmap_async(process, [(f, None, r, None, None, path_sub) for f in files for r in routeIDs]).get()
+    pool.close()
+    pool.join()
+
+
 if __name__ == '__main__':
     '''
     - script to compute and store node ratios of all taken nodes of Vienna's 6 simulation datasets 
@@ -61,24 +99,4 @@ if __name__ == '__main__':
 
     city = '01_Vienna'
 
-    path_orig = os.path.join(path_data, '01_Original', city)
-    path_sub = os.path.join(path_data, '02_Subgraphs', city)
-    path_graph = os.path.join(path_orig, [f for f in os.listdir(path_orig) if 'nx_graph_with_ec_with_bearing' in f][0])
-    path_routes = os.path.join(path_orig, [f for f in os.listdir(path_orig) if 'random_routes' in f][0])
-    files = [f for f in os.listdir(path_orig) if 'our_approach' in f]
-
-    # routes, graph and ids
-    routes = nx.read_gpickle(path_routes)
-    graph = NetworkGraph(path_graph)
-
-    routeIDs = list(range(100))
-
-    data = []
-    for f in files:
-        data.append(AgentData(os.path.join(path_orig, f)))
-
-    pool = mp.Pool(mp.cpu_count() - 1)
-    pool.starmap_async(process, [(files[i], data[i], r, graph, routes, path_sub)
-                                 for i in range(len(files)) for r in routeIDs]).get()
-    pool.close()
-    pool.join()
+    taken_nodes(city, path_data)
@@ -1,19 +1,17 @@
 import os
 import pandas as pd
-import numpy as np
 
+from utils.histogram import CountingHistogram
 
-if __name__ == '__main__':
-    '''
-    - script to analyse the taken node ratios of all taken nodes of Vienna's 6 simulation datasets 
-    - computation of the node ratio threshold
-    '''
-
-    #####################################################
-    path_data = os.path.join(os.path.normpath(os.getcwd() + os.sep + os.pardir), '01_Data')
-
-    city = '01_Vienna'
 
+def taken_nodes_analysis(city, path_data):
+    """
+    node ratio thresholds of the area extents based on the taken node ratios of all simulation datasets of a city
+    (stored as threshold_ratios.csv)
+    :param city: city (01_Vienna, 02_Mexico, 03_Djibouti)
+    :param path_data: data folder (01_Data)
+    :return:
+    """
     path_orig = os.path.join(path_data, '01_Original', city)
     path_sub = os.path.join(path_data, '02_Subgraphs', city)
     path_graph = os.path.join(path_orig, [f for f in os.listdir(path_orig) if 'nx_graph_with_ec_with_bearing' in f][0])
@@ -28,31 +26,31 @@ if __name__ == '__main__':
     # X% of all taken nodes / X% of all SUCCESSFULLY taken nodes, below chosen percentage (OPTION 1+2)
     # X% of all taken routes / X% of all SUCCESSFULLY taken routes, below chosen percentage (OPTION 3+4)
     percentages = [0.99, 0.999, 0.9999]
-    above_all, above_suc, routes_all = pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
-    count_all, count_suc = [], []
+
+    # one pass over all taken node files (read in chunks), exact counting histograms of node ratios
+    # (ratios rounded to 6 decimals): taken nodes above 1.05 and maximum ratio of each taken route
+    above_all, above_suc = CountingHistogram(decimals=6), CountingHistogram(decimals=6)
+    routes_all, routes_suc = CountingHistogram(decimals=6), CountingHistogram(decimals=6)
+    count_all, count_suc = 0, 0
 
     # loop routes
     for r in routeIDs:
         print(r)
-        all_rx = pd.DataFrame(columns=['id', 'x', 'y', 'l'])
-        vals_max_all = pd.DataFrame()
-        vals_max_suc = pd.DataFrame()
         # loop folders
         for f in folder:
             path = os.path.join(path_sub, 'boundingbox', 'alltakennodes', f, 'route_{:02d}_taken.csv'.format(r))
-            tk = pd.read_csv(path)
-            tk = tk.iloc[:, 1:]
-            tk['l'] = round(tk['l'], 6)
-            tk['dataset'] = f
-            vals_max_all[f] = [tk.l.max()]
-            vals_max_suc[f] = [tk[tk.success == 1.0].l.max()]
-            all_rx = pd.concat([all_rx, tk], ignore_index=True)
-        temp = all_rx.groupby(['agent_id', 'dataset', 'success'], axis=0, as_index=False).l.max()
-        routes_all = pd.concat([routes_all, temp], ignore_index=True)
-        above_all = pd.concat([above_all, all_rx[all_rx.l > 1.05]], ignore_index=True)
-        count_all.append(len(all_rx))
-        above_suc = pd.concat([above_suc, all_rx[(all_rx.l > 1.05) & (all_rx.success == 1)]], ignore_index=True)
-        count_suc.append(len(all_rx[all_rx.success == 1]))
+            route_max = []
+            for tk in pd.read_csv(path, usecols=['agent_id', 'success', 'l'], chunksize=1000000):
+                tk['l'] = round(tk['l'], 6)
+                above_all.add(tk.l[tk.l > 1.05])
+                above_suc.add(tk.l[(tk.l > 1.05) & (tk.success == 1)])
+                count_all += len(tk)
+                count_suc += int((tk.success == 1).sum())
+                route_max.append(tk.groupby(['agent_id', 'success'], as_index=False).l.max())
+            # maximum node ratio of each taken route (agent), over all chunks
+            route_max = pd.concat(route_max).groupby(['agent_id', 'success'], as_index=False).l.max()
+            routes_all.add(route_max.l)
+            routes_suc.add(route_max[route_max.success == 1].l)
 
     ####################################################################################################
 
@@ -60,23 +58,19 @@ if __name__ == '__main__':
     thresh_all_routes, thresh_suc_routes = [], []
 
     # threshold for all taken nodes (OPTION 1)
-    total_all = sum(count_all)
-    sorted_above_all = above_all.sort_values(by='l')
     for p in percentages:
-        ix_all = int(total_all - total_all * p)
-        thresh_all_nodes.append(sorted_above_all.iloc[-ix_all].l)
+        ix_all = int(count_all - count_all * p)
+        thresh_all_nodes.append(above_all.value(-ix_all))
 
     # threshold for all SUCCESSFULLY taken nodes (OPTION 2)
-    total_suc = sum(count_suc)
-    sorted_above_suc = above_suc.sort_values(by='l')
     for p in percentages:
-        ix_suc = int(total_suc - total_suc * p)
-        thresh_suc_nodes.append(sorted_above_suc.iloc[-ix_suc].l)
+        ix_suc = int(count_suc - count_suc * p)
+        thresh_suc_nodes.append(above_suc.value(-ix_suc))
 
     # threshold for all taken routes / all SUCCESSFULLY taken routes (OPTION 3+4)
     for p in percentages:
-        thresh_all_routes.append(np.quantile(routes_all.l, p))
-        thresh_suc_routes.append(np.quantile(routes_all[routes_all.success == 1].l, p))
+        thresh_all_routes.append(routes_all.quantile(p))
+        thresh_suc_routes.append(routes_suc.quantile(p))
 
     # area threshold ratios for four different options
     area_threshs = pd.DataFrame()
@@ -91,3 +85,17 @@ if __name__ == '__main__':
 
     save_path = os.path.join(path_data, '02_Subgraphs', 'threshold_ratios.csv')
     area_threshs.to_csv(save_path, float_format='%.3f')
+
+
+if __name__ == '__main__':
+    '''
+    - script to analyse the taken node ratios of all taken nodes of Vienna's 6 simulation datasets 
+    - computation of the node ratio threshold
+    '''
+
+    #####################################################
+    path_data = os.path.join(os.path.normpath(os.getcwd() + os.sep + os.pardir), '01_Data')
+
+    city = '01_Vienna'
+
+    taken_nodes_analysis(city, path_data)
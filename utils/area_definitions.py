@@ -1,4 +1,11 @@
+import numbers
+import numpy as np
 from shapely.geometry import Point, LineString, MultiPoint
+try:
+    from shapely import contains_xy
+except ImportError:  # shapely < 2.0
+    from shapely.vectorized import contains as contains_xy
+
 
 def area_min_max(g, sp, buffer):
     """
@@ -12,94 +19,254 @@ def area_min_max(g, sp, buffer):
     ymin = min(sp['y'][:]) - buffer
     ymax = max(sp['y'][:]) + buffer
 
-    nodes_inside = dict(id=[], x=[], y=[])
-    for n in g.graph:
-        pt = g.graph.nodes[n]['geom_utm']
-        if xmin <= pt.x <= xmax and ymin <= pt.y <= ymax:
-            nodes_inside['id'].append(n)
-            nodes_inside['x'].append(pt.x)
-            nodes_inside['y'].append(pt.y)
+    nodes_inside = g.get_nodes_in_bbox(xmin, ymin, xmax, ymax)
     return nodes_inside
 
 
-def area_beeline(g, sp, buffer):
+def area_beeline(g, sp, buffer, field=None):
     """
     :param g: NetworkGraph
     :param sp: shortest path, dict(id, x, y)
     :param buffer: additional buffer [m], int or float
+    :param field: distance field of the route (see distance_field), nodes inside the area as threshold on the field
+    instead of a polygon query (e.g. for many buffers of the same route)
     :return: surrounding polygon, nodes inside the area, dict(id, x, y)
     """
     st = Point(sp['x'][0], sp['y'][0])
     ed = Point(sp['x'][-1], sp['y'][-1])
     beeline = LineString([st, ed])
-    if buffer == 'l/2':
-        buffer = beeline.length / 2
-    elif buffer == 'l/4':
-        buffer = beeline.length / 4
-    elif buffer is type(int) or buffer is type(float):
-        buffer = buffer
-    else:
-        print('Please specify a suitable buffer: int, float or string ("l/2", "l/3").')
+    buffer = beeline_buffer(buffer, beeline.length)
     polygon = beeline.buffer(buffer)
+    if field is not None:
+        return polygon, area_field(field, 'beeline', buffer)
     nodes_inside = g.get_nodes_in_polygon(polygon)
     return polygon, nodes_inside
 
 
-def area_shortest_path(g, sp, buffer):
+def area_shortest_path(g, sp, buffer, field=None):
     """
     :param g: NetworkGraph
     :param sp: shortest path, dict(id, x, y)
     :param buffer: additional buffer [m], int or float
+    :param field: distance field of the route (see distance_field), nodes inside the area as threshold on the field
     :return: surrounding polygon, nodes inside the area, dict(id, x, y)
     """
     line = LineString([Point(sp['x'][i], sp['y'][i]) for i in range(len(sp['id']))])
     polygon = line.buffer(buffer)
+    if field is not None:
+        return polygon, area_field(field, 'shortest_path', buffer)
     nodes_inside = g.get_nodes_in_polygon(polygon)
     return polygon, nodes_inside
 
 
-def area_shortest_path_adj(g, sp, buffer):
+def area_shortest_path_adj(g, sp, buffer, k=4, within=False, max_length=None, field=None):
     """
     :param g: NetworkGraph
     :param sp: shortest path, dict(id, x, y)
     :param buffer: additional buffer [m], int or float
+    :param k: number of steps from the nodes of the shortest path (see k_hop_nodes)
+    :param within: all nodes within k steps instead of nodes at the end of walks of exactly k steps
+    :param max_length: nodes within this network distance [m] of the shortest path instead of k steps
+    :param field: distance field of the route with adjacent=True (see distance_field, only for the default 4 steps),
+    nodes inside the area as threshold on the field
     :return: surrounding polygon, nodes inside the area, dict(id, x, y)
     """
-    sp_nodes_adj = []
-    for sp_n in sp['id']:
-        for first_n in g.graph.neighbors(sp_n):
-            for second_n in g.graph.neighbors(first_n):
-                for third_n in g.graph.neighbors(second_n):
-                    for fourth_n in g.graph.neighbors(third_n):
-                        sp_nodes_adj.append(fourth_n)
-
-    nodeset = g.get_coords_nodelist(set(sp_nodes_adj))
-    pointset = MultiPoint([(nodeset['x'][i], nodeset['y'][i])
-                           for i in range(len(nodeset['x']))])
-    ch = pointset.convex_hull
+    if field is not None and (k != 4 or within or max_length is not None):
+        raise ValueError('distance field of area_shortest_path_adj only for nodes at the end of walks of 4 steps')
+    ch = _adjacent_hull(g, sp, k, within, max_length)
     polygon = ch.buffer(buffer)
+    if field is not None:
+        return polygon, area_field(field, 'shortest_path_adj', buffer)
     nodes_inside = g.get_nodes_in_polygon(polygon)
     return polygon, nodes_inside
 
 
-def area_taken_nodes(g, data, buffer):
+def _adjacent_hull(g, sp, k=4, within=False, max_length=None):
+    # convex hull of all nodes reached from the nodes of the shortest path (k steps or network distance)
+    if max_length is None:
+        ix = k_hop_nodes(g, sp['id'], k, within)
+    else:
+        ix = nodes_within_length(g, sp['id'], max_length)
+    c = g.compact
+    return MultiPoint(np.stack([c.x[ix], c.y[ix]], axis=1)).convex_hull
+
+
+def _neighbours(c, ix):
+    # node indices of all neighbours (successors if directed) of node indices ix, CSR adjacency
+    counts = c.indptr[ix + 1] - c.indptr[ix]
+    pos = np.repeat(c.indptr[ix] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    return c.indices[pos]
+
+
+def k_hop_nodes(g, sources, k=4, within=False):
+    """
+    nodes reached by k steps from the source nodes, multi-source frontier expansion on the CSR adjacency (every node
+    once per step instead of every walk): nodes at the end of a walk of exactly k steps (same nodes as k nested
+    loops over g.graph.neighbors) or, if within, all nodes within k steps (breadth first search with visited set)
+    :param g: NetworkGraph
+    :param sources: list of node ids
+    :param k: number of steps
+    :param within: all nodes within k steps (sources included)
+    :return: node indices (CompactGraph), in order of graph
+    """
+    c = g.compact
+    frontier = np.zeros(len(c), dtype=bool)
+    frontier[[c.index[n] for n in sources]] = True
+    visited = frontier.copy()
+    for _ in range(k):
+        reached = np.zeros(len(c), dtype=bool)
+        reached[_neighbours(c, np.flatnonzero(frontier))] = True
+        frontier = reached & ~visited if within else reached
+        visited |= reached
+        if not frontier.any():
+            break
+    return np.flatnonzero(visited if within else frontier)
+
+
+def nodes_within_length(g, sources, max_length):
     """
+    nodes within a network distance of the source nodes (multi-source dijkstra, edge length 1 if missing)
     :param g: NetworkGraph
-    :param data: filtered results (ID)
+    :param sources: list of node ids
+    :param max_length: maximum shortest path length [m] to the closest source node
+    :return: node indices (CompactGraph), in order of graph
+    """
+    import scipy.sparse as sps
+    from scipy.sparse.csgraph import dijkstra
+
+    c = g.compact
+    # CSR adjacency weighted by edge length, parallel edges: dijkstra uses the shortest one
+    w = np.where(np.isnan(c.length), 1.0, c.length)[c.adj_edge]
+    graph = sps.csr_matrix((w, c.indices, c.indptr), shape=(len(c), len(c)))
+    dist = dijkstra(graph, directed=True, indices=[c.index[n] for n in set(sources)], min_only=True,
+                    limit=max_length)
+    return np.flatnonzero(dist <= max_length)
+
+
+def beeline_buffer(buffer, length):
+    """
+    :param buffer: buffer [m], int or float (also numpy scalars), or string relative to beeline length ("l/2", "l/4")
+    :param length: beeline length [m]
+    :return: buffer [m]
+    """
+    if isinstance(buffer, numbers.Real) and not isinstance(buffer, bool):
+        return buffer
+    elif buffer == 'l/2':
+        return length / 2
+    elif buffer == 'l/4':
+        return length / 4
+    raise ValueError('Please specify a suitable buffer: int, float or string ("l/2", "l/4").')
+
+
+def distance_field(g, sp, adjacent=False):
+    """
+    distance of every node of the graph to the beeline and to the shortest path polyline (and to the convex hull of
+    area_shortest_path_adj, 0 inside), computed once per route: every buffer-based area is a threshold on the field
+    (field argument of area_beeline, area_shortest_path and area_shortest_path_adj, area_field_sweep for many buffers)
+    :param g: NetworkGraph
+    :param sp: shortest path, dict(id, x, y)
+    :param adjacent: also compute distance to the convex hull of the 4-step neighbours of the shortest path (slow)
+    :return: dict(id, x, y, beeline, shortest_path[, shortest_path_adj]) in order of graph, beeline length [m]
+    """
+    index = g.node_index
+    x, y = index.x, index.y
+    sx, sy = np.asarray(sp['x'], dtype=np.float64), np.asarray(sp['y'], dtype=np.float64)
+    field = dict(id=index.ids, x=x, y=y,
+                 beeline=polyline_distance(x, y, sx[[0, -1]], sy[[0, -1]]),
+                 shortest_path=polyline_distance(x, y, sx, sy))
+    if adjacent:
+        ch = _adjacent_hull(g, sp)
+        if ch.is_empty:
+            # no node reached by 4 steps (empty area for every buffer)
+            dist = np.full(len(x), np.inf)
+        else:
+            hull = np.asarray(ch.exterior.coords if ch.geom_type == 'Polygon' else ch.coords, dtype=np.float64)
+            dist = polyline_distance(x, y, hull[:, 0], hull[:, 1])
+            if ch.geom_type == 'Polygon':
+                dist[contains_xy(ch, x, y)] = 0.0
+        field['shortest_path_adj'] = dist
+    return field, float(np.hypot(sx[-1] - sx[0], sy[-1] - sy[0]))
+
+
+def polyline_distance(x, y, lx, ly, chunk=2 ** 22):
+    """
+    minimum euclidean distance of points to a polyline (point-to-segment distances, vectorized over points and
+    segments, points in chunks to limit memory)
+    :param x: x coordinates of points
+    :param y: y coordinates of points
+    :param lx: x coordinates of polyline vertices (a single vertex is a point)
+    :param ly: y coordinates of polyline vertices
+    :param chunk: maximum number of point-segment pairs per step
+    :return: distances
+    """
+    lx, ly = np.asarray(lx, dtype=np.float64), np.asarray(ly, dtype=np.float64)
+    if len(lx) == 1:
+        lx, ly = np.repeat(lx, 2), np.repeat(ly, 2)
+    ax, ay, dx, dy = lx[:-1], ly[:-1], np.diff(lx), np.diff(ly)
+    seg_len2 = dx ** 2 + dy ** 2
+    seg_len2[seg_len2 == 0] = np.inf  # zero length segment: distance to its vertex (t = 0)
+    dist = np.empty(len(x), dtype=np.float64)
+    step = max(chunk // max(len(ax), 1), 1)
+    for i in range(0, len(x), step):
+        px, py = x[i:i + step, None] - ax, y[i:i + step, None] - ay
+        t = np.clip((px * dx + py * dy) / seg_len2, 0.0, 1.0)
+        dist[i:i + step] = np.sqrt((px - t * dx) ** 2 + (py - t * dy) ** 2).min(axis=1)
+    return dist
+
+
+def area_field(field, key, buffer):
+    """
+    nodes inside a buffer-based area as threshold on the distance field (same nodes as the buffer polygon up to
+    nodes at the boundary and at the round caps, which the polygon approximates)
+    :param field: distance field (see distance_field)
+    :param key: 'beeline', 'shortest_path' or 'shortest_path_adj'
+    :param buffer: buffer [m], int or float
+    :return: nodes inside the area, dict(id, x, y)
+    """
+    ix = np.flatnonzero(field[key] < buffer)
+    return dict(id=[field['id'][i] for i in ix], x=field['x'][ix].tolist(), y=field['y'][ix].tolist())
+
+
+def area_field_sweep(field, key, buffers):
+    """
+    nodes inside the areas of many buffers from one sort of the distance field
+    :param field: distance field (see distance_field)
+    :param key: 'beeline', 'shortest_path' or 'shortest_path_adj'
+    :param buffers: list of buffers [m]
+    :return: list of nodes inside the area, dict(id, x, y), per buffer
+    """
+    order = np.argsort(field[key], kind='stable')
+    counts = np.searchsorted(field[key][order], buffers, side='left')
+    areas = []
+    for count in counts.tolist():
+        ix = np.sort(order[:count])
+        areas.append(dict(id=[field['id'][i] for i in ix], x=field['x'][ix].tolist(), y=field['y'][ix].tolist()))
+    return areas
+
+
+def area_taken_nodes(g, data, buffer, route=None):
+    """
+    :param g: NetworkGraph
+    :param data: AgentData
     :param buffer: additional buffer [m], int or float
-    :return: surrounding polygon, nodes inside the area, dict(id, x, y), list with all routes
-    """
-    edges = data.path_taken_edges.apply(eval)
-    all_taken = []
-    nodelist = []
-    for i in range(3000):
-        nodes = g.get_nodes_of_route(edges[i])
-        all_taken.extend(nodes['id'])
-        nodelist.append(nodes['id'])
-
-    nodeset = g.get_coords_nodelist(set(all_taken))
-    pointset = MultiPoint([(nodeset['x'][i], nodeset['y'][i])
-                           for i in range(len(nodeset['x']))])
+    :param route: route id (default: the only route of data)
+    :return: surrounding polygon, nodes inside the area, dict(id, x, y), list with taken nodes of all trajectories
+    of route (sorted by agent_id)
+    """
+    if route is None:
+        routes = np.unique(data.data.route_id.to_numpy())
+        if len(routes) != 1:
+            raise ValueError('route of area_taken_nodes needed for data of {:d} routes'.format(len(routes)))
+        route = routes[0].item()
+
+    # taken nodes of all trajectories in one array, split per trajectory
+    rows, nodes = data.route_nodes(route)
+    start, end = data.route_rows(route)
+    bounds = np.searchsorted(rows, np.arange(start, end + 1))
+    nodelist = [nodes[i:j].tolist() for i, j in zip(bounds[:-1], bounds[1:])]
+
+    ix = g.node_index.lookup(np.unique(nodes))
+    pointset = MultiPoint(np.stack([g.node_index.x[ix], g.node_index.y[ix]], axis=1))
     ch = pointset.convex_hull
     polygon = ch.buffer(buffer)
     nodes_inside = g.get_nodes_in_polygon(polygon)
@@ -116,8 +283,7 @@ def area_node_ratios(g, area, sp_length, ratio, buffer):
     :return: surrounding polygon, nodes inside the area, dict(id, x, y)
     """
     nodeset = area[(area.l / sp_length <= ratio) & (area.l / sp_length != 0.)]
-    pointset = MultiPoint([(nodeset.x.iloc[i], nodeset.y.iloc[i])
-                           for i in range(len(nodeset))])
+    pointset = MultiPoint(nodeset[['x', 'y']].to_numpy(dtype=float))
     ch = pointset.convex_hull
     polygon = ch.buffer(buffer)
     nodes_inside = g.get_nodes_in_polygon(polygon)
@@ -1,78 +1,60 @@
 import numpy as np
+import shapely
 from shapely.geometry import Point
 
+# vectorized coordinate extraction (shapely >= 2.0)
+_vectorized = hasattr(shapely, 'get_coordinates')
+
 
 def compute_bearing_attributes(g):
     """
     function to compute and add edge attribute "bearing" to existing graph
+    (all edges at once, based on arrays of node coordinates and edge geometry vertices)
     :param g: NetworkGraph without edge attribute "bearing"
     :return: g: NetworkGraph with edge attribute "bearing"
     """
-
-    # counters
-    count_straight, count_non_straight = 0, 0
-    count_loops, count_none = 0, 0
-
-    # list of differences for node bearings (1/2 are first/last node of edge segment)
-    diffs_1, diffs_2 = [], []
-
-    # loop all edges in graph
-    for u, v, data in g.edges(data=True):
-        if u != v:
-            first, last = g.graph.nodes[u]['geom_utm'], g.graph.nodes[v]['geom_utm']
-            straight_line = first.distance(last)
-
-            # junction is None
-            if straight_line == 0.0:
-                # bearing is set to NaN
-                count_none += 1
-                data['bearing'] = float('NaN')
-
-            # straight street segment (difference < 1mm)
-            elif np.abs(straight_line - data['length_utm_m']) < 1e-3:
-                # bearing is compass heading (first to last node)
-                bearing = (90 - np.rad2deg(np.arctan2(last.y - first.y, last.x - first.x))) % 360
-                data['bearing'] = bearing
-                count_straight += 1
-
-            # curved street segment (difference >= 1mm)
-            else:
-                # bearing is compass heading (first to last node)
-                bearing = (90 - np.rad2deg(np.arctan2(last.y - first.y, last.x - first.x))) % 360
-                data['bearing'] = bearing
-                count_non_straight += 1
-
-                # check differences in simplified compass heading and more complex node bearing
-
-                # get closest adjacent point, line-of-sight from first and last node respectively
-                first_adj = closest_curve_point(g.graph, u, v, first)
-                last_adj = closest_curve_point(g.graph, u, v, last)
-
-                # compute node bearing (1/2 are first/last node of edge segment)
-                bearing1 = (90 - np.rad2deg(np.arctan2(first_adj.y - first.y, first_adj.x - first.x))) % 360
-                bearing2 = (90 - np.rad2deg(np.arctan2(last_adj.y - last.y, last_adj.x - last.x))) % 360
-
-                # compute simplified straight
-                bearing_simplified_1 = bearing
-                bearing_simplified_2 = (bearing_simplified_1 + 180) % 360
-
-                # compute differences (consider all cases)
-                if bearing_simplified_1 > 270 and bearing1 < 90:
-                    diff1 = ((360 - bearing_simplified_1) + bearing1)
-                elif bearing1 > 270 and bearing_simplified_1 < 90:
-                    diff1 = ((360 - bearing1) + bearing_simplified_1)
-                else:
-                    diff1 = (np.abs(bearing1 - bearing_simplified_1))
-                if bearing_simplified_2 > 270 and bearing2 < 90:
-                    diff2 = ((360 - bearing_simplified_2) + bearing2)
-                elif bearing2 > 270 and bearing_simplified_2 < 90:
-                    diff2 = ((360 - bearing2) + bearing_simplified_2)
-                else:
-                    diff2 = (np.abs(bearing2 - bearing_simplified_2))
-                diffs_1.append(diff1)
-                diffs_2.append(diff2)
-        else:
-            count_loops += 1
+    c = g.compact
+    loops = c.edge_u == c.edge_v
+    x0, y0, x1, y1 = c.x[c.edge_u], c.y[c.edge_u], c.x[c.edge_v], c.y[c.edge_v]
+    straight_line = np.sqrt((x0 - x1) ** 2 + (y0 - y1) ** 2)
+
+    # junction is None (bearing NaN), straight street segment (difference < 1mm), curved street segment
+    none = ~loops & (straight_line == 0.0)
+    straight = ~loops & ~none & (np.abs(straight_line - c.length) < 1e-3)
+    curved = ~loops & ~none & ~straight
+
+    # bearing is compass heading (first to last node)
+    bearing = np.where(none, np.nan, compass_bearing(x0, y0, x1, y1))
+
+    # check differences in simplified compass heading and more complex node bearing of curved segments:
+    # closest adjacent point of edge geometry (key 0), line-of-sight from first and last node respectively
+    ix = np.flatnonzero(curved)
+    geoms = [d['geom_utm'] for d in _edge_data(g.graph)]
+    geom_ix = np.array([_first_edge(c, i) for i in ix.tolist()], dtype=np.int64)
+    used, geom_ix = np.unique(geom_ix, return_inverse=True)
+    coords, offsets = geometry_coordinates([geoms[i] for i in used.tolist()])
+    first_adj = closest_curve_points(coords, offsets, geom_ix, x0[ix], y0[ix])
+    last_adj = closest_curve_points(coords, offsets, geom_ix, x1[ix], y1[ix])
+
+    # compute node bearing (1/2 are first/last node of edge segment) and simplified straight
+    bearing1 = compass_bearing(x0[ix], y0[ix], first_adj[0], first_adj[1])
+    bearing2 = compass_bearing(x1[ix], y1[ix], last_adj[0], last_adj[1])
+    bearing_simplified_1 = bearing[ix]
+    bearing_simplified_2 = (bearing_simplified_1 + 180) % 360
+
+    # compute differences (consider all cases)
+    diffs_1 = _bearing_difference(bearing_simplified_1, bearing1)
+    diffs_2 = _bearing_difference(bearing_simplified_2, bearing2)
+
+    # bearing written back to all edges except self-loops
+    for data, b, loop in zip(_edge_data(g.graph), bearing.tolist(), loops.tolist()):
+        if not loop:
+            data['bearing'] = b
+    g.reset_cache()
+
+    count_none, count_loops = int(none.sum()), int(loops.sum())
+    count_straight, count_non_straight = int(straight.sum()), int(curved.sum())
+    diffs = np.concatenate([diffs_1, diffs_2])
 
     nr_edges = len(g.edges)
     print('Number of edges: {:6d}'.format(nr_edges))
@@ -80,11 +62,91 @@ def compute_bearing_attributes(g):
     print('Self-loops:      {:6d}, {:5.2f}%'.format(count_loops, count_loops/nr_edges*100))
     print('Straight:        {:6d}, {:5.2f}%'.format(count_straight, count_straight/nr_edges*100))
     print('Non-straight:    {:6d}, {:5.2f}%'.format(count_non_straight, count_non_straight/nr_edges*100))
-    print('Median bearing difference (node bearing - simplified): {:.2f}°'.format(np.median(diffs_1 + diffs_2)))
+    print('Median bearing difference (node bearing - simplified): {:.2f}°'.format(np.median(diffs[~np.isnan(diffs)])))
 
     return g
 
 
+def incidence_bearings(g):
+    """
+    bearing of all node-edge incidences (independent of any destination): compass heading from node to adjacent
+    node (straight edge) or to closest vertex of edge geometry (curved edge), edge with key 0 between the nodes
+    :param g: NetworkGraph
+    :return: node index, adjacent node index (CompactGraph) and bearing of each incidence (incidences with adjacent
+    node at distance 0 are left out)
+    """
+    c = g.compact
+
+    # node pairs of adjacency (out-edges if directed), parallel edges once
+    pairs = np.unique(np.stack([c.adj_source, c.indices], axis=1), axis=0) if len(c.indices) > 0 \
+        else np.zeros((0, 2), dtype=np.int64)
+    node, adj = pairs[:, 0], pairs[:, 1]
+    dist_straight = np.sqrt((c.x[node] - c.x[adj]) ** 2 + (c.y[node] - c.y[adj]) ** 2)
+    keep = dist_straight != 0.0
+    node, adj, dist_straight = node[keep], adj[keep], dist_straight[keep]
+    edge = np.array([_edge(c, u, v) for u, v in zip(node.tolist(), adj.tolist())], dtype=np.int64)
+
+    # straight edges: bearing to adjacent node, curved edges: bearing to closest vertex of edge geometry
+    bearing = compass_bearing(c.x[node], c.y[node], c.x[adj], c.y[adj])
+    curved = np.flatnonzero(~(np.abs(dist_straight - c.length[edge]) < 1e-3))
+    geoms = [d['geom_utm'] for d in _edge_data(g.graph)]
+    used, geom_ix = np.unique(edge[curved], return_inverse=True)
+    coords, offsets = geometry_coordinates([geoms[i] for i in used.tolist()])
+    px, py = closest_curve_points(coords, offsets, geom_ix, c.x[node[curved]], c.y[node[curved]])
+    bearing[curved] = compass_bearing(c.x[node[curved]], c.y[node[curved]], px, py)
+    return node, adj, bearing
+
+
+def compass_bearing(x0, y0, x1, y1):
+    # compass heading from (x0, y0) to (x1, y1) [°]
+    return (90 - np.rad2deg(np.arctan2(y1 - y0, x1 - x0))) % 360
+
+
+def geometry_coordinates(geoms):
+    """
+    coordinates of all vertices of (multi)linestrings as flat array
+    :param geoms: list of geometries
+    :return: coords (n x 2), offsets (vertices of geometry i are coords[offsets[i]:offsets[i+1]])
+    """
+    if _vectorized:
+        coords, index = shapely.get_coordinates(np.array(geoms, dtype=object), return_index=True)
+        counts = np.bincount(index, minlength=len(geoms))
+    else:
+        coords, counts = [], []
+        for geom in geoms:
+            points = [p for line in geom.geoms for p in line.coords] if hasattr(geom, 'geoms') else list(geom.coords)
+            coords += [p[:2] for p in points]
+            counts.append(len(points))
+        coords = np.array(coords, dtype=np.float64).reshape(-1, 2)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return coords, offsets
+
+
+def closest_curve_points(coords, offsets, geom_ix, x, y):
+    """
+    closest vertex of geometry to initial node for many queries at once (vertices at distance 0 are excluded)
+    :param coords: vertex coordinates (see geometry_coordinates)
+    :param offsets: vertex offsets of geometries
+    :param geom_ix: geometry index of each query
+    :param x: x coordinates of initial nodes
+    :param y: y coordinates of initial nodes
+    :return: x, y coordinates of closest vertices (NaN if there is no vertex with distance > 0)
+    """
+    counts = offsets[geom_ix + 1] - offsets[geom_ix]
+    query = np.repeat(np.arange(len(geom_ix)), counts)
+    pos = np.repeat(offsets[geom_ix] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    dist = np.sqrt((x[query] - coords[pos, 0]) ** 2 + (y[query] - coords[pos, 1]) ** 2)
+    dist[dist == 0] = np.inf
+
+    # first vertex with minimum distance of every query
+    order = np.lexsort((np.arange(len(query)), dist, query))
+    first = order[np.concatenate([[True], query[order][1:] != query[order][:-1]])] if len(order) > 0 else order
+    px, py = np.full(len(geom_ix), np.nan), np.full(len(geom_ix), np.nan)
+    found = first[np.isfinite(dist[first])]
+    px[query[found]], py[query[found]] = coords[pos[found], 0], coords[pos[found], 1]
+    return px, py
+
+
 def closest_curve_point(g, u, v, init_node):
     """
     function to find closest adjacent point within linestring to initial node
@@ -94,30 +156,35 @@ def closest_curve_point(g, u, v, init_node):
     :param init_node: geometry of initial node
     :return: geometry of point closest to initial node
     """
+    coords, offsets = geometry_coordinates([g[u][v][0]['geom_utm']])
+    px, py = closest_curve_points(coords, offsets, np.zeros(1, dtype=np.int64),
+                                  np.array([init_node.x]), np.array([init_node.y]))
+    if np.isnan(px[0]):
+        raise ValueError('no point of edge ({}, {}) with distance > 0 to initial node'.format(u, v))
+    return Point(px[0], py[0])
+
+
+def _bearing_difference(simplified, bearing):
+    return np.where((simplified > 270) & (bearing < 90), (360 - simplified) + bearing,
+                    np.where((bearing > 270) & (simplified < 90), (360 - bearing) + simplified,
+                             np.abs(bearing - simplified)))
+
+
+def _edge_data(graph):
+    # edge attribute dicts in order of graph.edges (same order as CompactGraph edge arrays)
+    return (e[-1] for e in graph.edges(data=True))
+
+
+def _first_edge(c, i):
+    # index of edge with key 0 between the nodes of edge i (geometry used for curved edges)
+    if not c.multigraph:
+        return i
+    return _edge(c, c.edge_u[i], c.edge_v[i])
 
-    # edge under consideration
-    edge = g[u][v]
-
-    # check if edge is multilinestring and handle accordingly
-    try:
-        len(edge[0]['geom_utm'].geoms)
-        points = []
-        # add all points within multilinestring to point list
-        for line in edge[0]['geom_utm'].geoms:
-            points += line.coords
-    except:
-        # add all points within linestring to point list
-        points = list(edge[0]['geom_utm'].coords)
-
-    distances, pointlist = [], []
-    for point in points:
-        # compute distance to initial node
-        dist = init_node.distance(Point(point))
-        if dist != 0:
-            distances.append(dist)
-            pointlist.append(point)
-
-    # find point with minimum distance to init_node
-    pt_min = Point(pointlist[np.argmin(distances)])
-    return pt_min
 
+def _edge(c, u, v):
+    # index of edge with key 0 (None if not multigraph) between node indices u and v
+    j = c.edge_id(c.ids[u], c.ids[v], 0 if c.multigraph else None)
+    if j == -1:
+        raise KeyError((c.ids[u], c.ids[v], 0))
+    return j
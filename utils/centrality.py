@@ -0,0 +1,334 @@
+import os
+import math
+import json
+import hashlib
+import numpy as np
+from heapq import heappush, heappop, heapify
+from itertools import count
+
+
+def local_centralities(compact, radius, sources=None, cache=None):
+    """
+    local closeness, betweenness and straightness centralities of a CompactGraph (same values as momepy with
+    radius, distance and weight 'length_utm_m', straightness not normalized):
+    - one dijkstra bounded by the largest radius per node (ego graph) gives closeness and straightness of all radii
+    - betweenness of a node within its ego graph of each radius, graph undirected with shortest of parallel edges
+    :param compact: CompactGraph
+    :param radius: radius of local centralities [m] or list of radii
+    :param sources: node indices to compute (default all nodes), NaN for all other nodes
+    :param cache: city-wide values (see read_centrality_cache), values of nodes whose ego graphs are completely
+    within the (induced) subgraph are taken from the cache, only nodes near the boundary are computed
+    :return: dict {'cc<radius>': array, 'cb<radius>': array, 'cs<radius>': array} for each radius
+    """
+    n = len(compact)
+    radii = radius_list(radius)
+    selected = np.zeros(n, dtype=bool)
+    selected[np.arange(n) if sources is None else np.asarray(sources, dtype=np.int64)] = True
+
+    if cache is None:
+        metrics = _metrics(compact, radii, np.flatnonzero(selected))
+    else:
+        city_ix = np.array([cache['index'][i] for i in compact.ids], dtype=np.int64)
+        band = boundary_band(cache, city_ix, radii[-1])
+        metrics = _metrics(compact, radii, np.flatnonzero(selected & band))
+        reuse = selected & ~band
+        for name, values in metrics.items():
+            values[reuse] = cache[name][city_ix[reuse]]
+
+    # nodes without any edge are not part of the graph used for betweenness
+    has_edges = np.bincount(np.concatenate([compact.edge_u, compact.edge_v]), minlength=n) > 0
+
+    result = {}
+    for r in radii:
+        k, tot = metrics['k' + str(r)], metrics['tot' + str(r)]
+        # closeness within ego graph (k nodes), normalized to the number of nodes in graph
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cc = (k - 1.0) / tot
+            cc *= (k - 1.0) / (n - 1)
+        result['cc' + str(r)] = np.where(selected, np.where((tot > 0.0) & (k > 1), cc, 0.0), np.nan)
+        result['cb' + str(r)] = np.where(has_edges, metrics['cb' + str(r)], np.nan)
+        result['cs' + str(r)] = metrics['cs' + str(r)]
+    return result
+
+
+def centrality_cache(compact, radius, sources=None):
+    """
+    city-wide values of local centralities (to reuse them in subgraphs, see local_centralities)
+    :param compact: CompactGraph of city graph
+    :param radius: radius [m] or list of radii
+    :param sources: node indices to compute (default all nodes), NaN for all other nodes
+    :return: dict {'k<radius>': ego graph size, 'tot<radius>': sum of distances, 'cb<radius>', 'cs<radius>'}
+    """
+    sources = np.arange(len(compact)) if sources is None else np.asarray(sources, dtype=np.int64)
+    return _metrics(compact, radius_list(radius), sources)
+
+
+def cache_fingerprint(path_graph, radius):
+    """
+    fingerprint of city-wide values: content of city graph (file or graph store folder), radii and code of this module
+    :param path_graph: path of city graph
+    :param radius: radius [m] or list of radii
+    :return: hex digest
+    """
+    files = sorted(os.path.join(path_graph, f) for f in os.listdir(path_graph)) if os.path.isdir(path_graph) \
+        else [path_graph]
+    h = hashlib.sha256(json.dumps(radius_list(radius)).encode())
+    for file in files + [os.path.abspath(__file__)]:
+        h.update(os.path.basename(file).encode())
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+def valid_centrality_cache(path, fingerprint):
+    """
+    :param path: file of city-wide values (see write_centrality_cache)
+    :param fingerprint: fingerprint of current city graph and radii (see cache_fingerprint)
+    :return: True if file exists and was computed from the same graph, radii and code
+    """
+    if not os.path.exists(path):
+        return False
+    with np.load(path) as f:
+        return 'fingerprint' in f.files and str(f['fingerprint']) == fingerprint
+
+
+def write_centrality_cache(path, compact, metrics, fingerprint):
+    """
+    store city-wide values with node ids and undirected adjacency (shortest edge) of city graph
+    :param path: output file (*.npz)
+    :param compact: CompactGraph of city graph
+    :param metrics: dict of arrays (see centrality_cache)
+    :param fingerprint: fingerprint of city graph and radii (see cache_fingerprint)
+    :return:
+    """
+    u = np.concatenate([compact.edge_u, compact.edge_v])
+    v = np.concatenate([compact.edge_v, compact.edge_u])
+    w = np.concatenate([compact.length, compact.length])
+    w = np.where(np.isnan(w), 1.0, w)
+    keep = u != v
+    u, v, w = u[keep], v[keep], w[keep]
+    order = np.lexsort((w, v, u))
+    u, v, w = u[order], v[order], w[order]
+    first = np.concatenate([[True], (u[1:] != u[:-1]) | (v[1:] != v[:-1])]) if len(u) > 0 else np.zeros(0, dtype=bool)
+    u, v, w = u[first], v[first], w[first]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(u, minlength=len(compact)))]).astype(np.int64)
+    np.savez(path, ids=np.array(compact.ids), indptr=indptr, indices=v, weight=w, fingerprint=np.array(fingerprint),
+             **metrics)
+
+
+def read_centrality_cache(path):
+    """
+    :param path: file of city-wide values (see write_centrality_cache)
+    :return: dict of arrays and index {node id: index in arrays}
+    """
+    with np.load(path) as f:
+        cache = {a: f[a] for a in f.files}
+    ids = [tuple(i) for i in cache['ids'].tolist()] if cache['ids'].ndim == 2 else cache['ids'].tolist()
+    cache['index'] = {n: i for i, n in enumerate(ids)}
+    return cache
+
+
+def boundary_band(cache, city_ix, radius):
+    """
+    nodes of an induced subgraph of the city graph within radius of a node outside the subgraph (ego graphs in
+    city graph and subgraph may differ), based on one multi-source dijkstra out of the outside nodes
+    :param cache: city-wide values (see read_centrality_cache)
+    :param city_ix: index of subgraph nodes in city graph
+    :param radius: radius [m]
+    :return: boolean array (one value per subgraph node)
+    """
+    indptr, indices, weight = cache['indptr'], cache['indices'], cache['weight']
+    local = np.full(len(indptr) - 1, -1, dtype=np.int64)
+    local[city_ix] = np.arange(len(city_ix))
+
+    # adjacency entries of subgraph nodes
+    starts, lens = indptr[city_ix], indptr[city_ix + 1] - indptr[city_ix]
+    row = np.repeat(np.arange(len(city_ix)), lens)
+    pos = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+    nbr, w = local[indices[pos]], weight[pos]
+
+    # distance to the closest outside neighbour, margin for rounding of distances
+    limit = radius * (1 + 1e-9) + 1e-6
+    dist = np.full(len(city_ix), np.inf)
+    np.minimum.at(dist, row[nbr < 0], w[nbr < 0])
+
+    adj = [[] for _ in range(len(city_ix))]
+    for a, b, l in zip(row[nbr >= 0].tolist(), nbr[nbr >= 0].tolist(), w[nbr >= 0].tolist()):
+        adj[a].append((b, l))
+    heap = [(d, i) for i, d in enumerate(dist.tolist()) if d <= limit]
+    heapify(heap)
+    done = np.zeros(len(city_ix), dtype=bool)
+    while heap:
+        d, v = heappop(heap)
+        if done[v]:
+            continue
+        done[v] = True
+        for b, l in adj[v]:
+            if d + l <= limit and d + l < dist[b]:
+                dist[b] = d + l
+                heappush(heap, (d + l, b))
+    return done
+
+
+def radius_list(radius):
+    """
+    :param radius: radius [m] or list of radii, whole meters (e.g. 800 or 800.0)
+    :return: sorted list of int radii (attribute names cc<radius>, cb<radius>, cs<radius>)
+    """
+    radii = radius if isinstance(radius, (list, tuple)) else [radius]
+    if any(r != int(r) for r in radii):
+        raise ValueError('radius has to be a whole number of meters: {}'.format(radius))
+    return sorted(int(r) for r in radii)
+
+
+def _metrics(compact, radii, sources):
+    # ego graph size, sum of distances, betweenness and straightness of source nodes for each radius
+    n = len(compact)
+    adj = _adjacency(compact)
+    adj_u = _undirected_adjacency(compact) if compact.directed else adj
+    x, y = _coordinates(compact)
+
+    metrics = {}
+    for r in radii:
+        for m in ['k', 'tot', 'cb', 'cs']:
+            metrics[m + str(r)] = np.full(n, np.nan)
+    for i in sources.tolist():
+        ball = _ball(adj, i, radii[-1])
+        ball_u = ball if not compact.directed else _ball(adj_u, i, radii[-1])
+        for r in radii:
+            # ego graph of smaller radius = nodes of ball up to radius (ball in order of distance)
+            ego, ego_u = _within(ball, r), _within(ball_u, r)
+            metrics['k' + str(r)][i] = len(ego)
+            metrics['tot' + str(r)][i] = sum(ego.values())
+            metrics['cs' + str(r)][i] = _straightness(ego, i, x, y)
+            metrics['cb' + str(r)][i] = _betweenness(adj_u, i, ego_u)
+    return metrics
+
+
+def _within(ball, radius):
+    # nodes of ball within radius
+    if next(reversed(ball.values())) <= radius:
+        return ball
+    return {v: d for v, d in ball.items() if d <= radius}
+
+
+def _adjacency(compact):
+    # neighbours (out-neighbours if directed) with length of shortest parallel edge, no self-loops
+    length = np.where(np.isnan(compact.length), 1.0, compact.length)[compact.adj_edge].tolist()
+    adj = [{} for _ in range(len(compact))]
+    for u, v, l in zip(compact.adj_source.tolist(), compact.indices.tolist(), length):
+        if u != v and (v not in adj[u] or l < adj[u][v]):
+            adj[u][v] = l
+    return [list(a.items()) for a in adj]
+
+
+def _undirected_adjacency(compact):
+    # undirected graph as NetworkGraph.keep_only_shortest_edge: shortest parallel edge of the direction listed last
+    length = np.where(np.isnan(compact.length), 1.0, compact.length).tolist()
+    edge_u, edge_v = compact.edge_u.tolist(), compact.edge_v.tolist()
+    last = {}
+    for u, v in zip(edge_u, edge_v):
+        last[(min(u, v), max(u, v))] = (u, v)
+    shortest = {}
+    for u, v, l in zip(edge_u, edge_v, length):
+        pair = (min(u, v), max(u, v))
+        if u != v and last[pair] == (u, v) and (pair not in shortest or l < shortest[pair]):
+            shortest[pair] = l
+    adj = [[] for _ in range(len(compact))]
+    for (u, v), l in shortest.items():
+        adj[u].append((v, l))
+        adj[v].append((u, l))
+    return adj
+
+
+def _coordinates(compact):
+    # momepy uses the node ids as coordinates (if ids are coordinate tuples), else geom_utm
+    if all(isinstance(i, tuple) and len(i) >= 2 for i in compact.ids):
+        return [i[0] for i in compact.ids], [i[1] for i in compact.ids]
+    return compact.x.tolist(), compact.y.tolist()
+
+
+def _ball(adj, source, radius):
+    """
+    dijkstra bounded by radius
+    :return: dict {node: distance} of all nodes within radius, in order of distance
+    """
+    dist, seen, heap = {}, {source: 0.0}, [(0.0, source)]
+    while heap:
+        d, v = heappop(heap)
+        if v in dist:
+            continue
+        dist[v] = d
+        for w, l in adj[v]:
+            vw = d + l
+            if vw > radius:
+                continue
+            if w not in dist and (w not in seen or vw < seen[w]):
+                seen[w] = vw
+                heappush(heap, (vw, w))
+    return dist
+
+
+def _straightness(ball, source, x, y):
+    # sum of euclidean distance / network distance to all nodes of ego graph, divided by number of nodes - 1
+    if len(ball) <= 1:
+        return 0.0
+    s = 0.0
+    for t, d in ball.items():
+        # nodes at network distance 0 are skipped (division by zero in momepy)
+        if t != source and d > 0:
+            s += math.sqrt((x[source] - x[t]) ** 2 + (y[source] - y[t]) ** 2) / d
+    return s * (1.0 / (len(ball) - 1.0))
+
+
+def _betweenness(adj, node, members):
+    """
+    betweenness of node in the graph induced by members (brandes, endpoints not included, undirected: 0.5 scale)
+    :param adj: undirected adjacency
+    :param node: node index
+    :param members: nodes of ego graph
+    :return: betweenness centrality of node
+    """
+    b = 0.0
+    for s in members:
+        if s == node:
+            continue
+        order, pred, sigma = _shortest_paths(adj, s, members)
+        if node not in sigma:
+            continue
+        delta = dict.fromkeys(order, 0.0)
+        while order:
+            w = order.pop()
+            coeff = (1.0 + delta[w]) / sigma[w]
+            for v in pred[w]:
+                delta[v] += sigma[v] * coeff
+        b += delta[node]
+    return b * 0.5
+
+
+def _shortest_paths(adj, s, members):
+    # dijkstra with number of shortest paths and predecessors (as networkx betweenness_centrality)
+    order, pred, sigma, dist = [], {s: []}, {s: 1.0}, {}
+    seen, c = {s: 0.0}, count()
+    heap = [(0.0, next(c), s, s)]
+    while heap:
+        d, _, p, v = heappop(heap)
+        if v in dist:
+            continue
+        sigma[v] += sigma[p]
+        order.append(v)
+        dist[v] = d
+        for w, l in adj[v]:
+            if w not in members:
+                continue
+            vw = d + l
+            if w not in dist and (w not in seen or vw < seen[w]):
+                seen[w] = vw
+                heappush(heap, (vw, next(c), v, w))
+                sigma[w] = 0.0
+                pred[w] = [v]
+            elif vw == seen[w]:
+                sigma[w] += sigma[v]
+                pred[w].append(v)
+    return order, pred, sigma
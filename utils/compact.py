@@ -0,0 +1,118 @@
+import re
+import copy
+import numpy as np
+
+
+class CompactGraph():
+    """
+    array representation of a networkx graph (built from NetworkGraph.graph):
+    - CSR adjacency (indptr, indices, adj_edge), neighbours in order of networkx adjacency
+    - node arrays (x, y, num_ways, delta, delta_t, centralities), nodes in order of graph
+    - edge arrays (edge_u, edge_v, length, bearing), edges in order of graph.edges(keys=True)
+    """
+    def __init__(self, graph):
+        self.source = graph
+        self.directed = graph.is_directed()
+        self.multigraph = graph.is_multigraph()
+
+        # nodes
+        self.ids = list(graph)
+        self.index = {n: i for i, n in enumerate(self.ids)}
+        nodes = graph.nodes
+        self.x = np.array([nodes[n]['geom_utm'].x for n in self.ids], dtype=np.float64)
+        self.y = np.array([nodes[n]['geom_utm'].y for n in self.ids], dtype=np.float64)
+        self.num_ways = np.array([_value(nodes[n].get('num_ways'), -1) for n in self.ids], dtype=np.int64)
+        self.delta = np.array([_value(nodes[n].get('delta'), np.nan) for n in self.ids], dtype=np.float64)
+        self.delta_t = np.array([_value(nodes[n].get('delta_t'), np.nan) for n in self.ids], dtype=np.float64)
+
+        # local centralities (e.g. cc800, cb800, cs800), NaN if missing
+        names = set()
+        for n in self.ids:
+            names.update(a for a in nodes[n] if re.match(r'^c[cbs]\d+$', a))
+        self.centralities = {a: np.array([_value(nodes[n].get(a), np.nan) for n in self.ids], dtype=np.float64)
+                             for a in sorted(names)}
+
+        # edges
+        edges = list(graph.edges(keys=True, data=True)) if self.multigraph else \
+            [(u, v, None, d) for u, v, d in graph.edges(data=True)]
+        self.edge_u = np.array([self.index[e[0]] for e in edges], dtype=np.int64)
+        self.edge_v = np.array([self.index[e[1]] for e in edges], dtype=np.int64)
+        self.edge_key = [e[2] for e in edges]
+        self.length = np.array([_value(e[3].get('length_utm_m'), np.nan) for e in edges], dtype=np.float64)
+        self.bearing = np.array([_value(e[3].get('bearing'), np.nan) for e in edges], dtype=np.float64)
+        self.edge_ids = {(e[0], e[1], e[2]): i for i, e in enumerate(edges)}
+
+        # CSR adjacency (out-edges if directed, both directions if undirected)
+        indptr, indices, adj_edge = [0], [], []
+        for n in self.ids:
+            for nbr, data in graph._adj[n].items():
+                for k in (data if self.multigraph else [None]):
+                    indices.append(self.index[nbr])
+                    adj_edge.append(self.edge_id(n, nbr, k))
+            indptr.append(len(indices))
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.indices = np.array(indices, dtype=np.int64)
+        self.adj_edge = np.array(adj_edge, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def adj_source(self):
+        # node index of each adjacency entry
+        return np.repeat(np.arange(len(self.ids)), np.diff(self.indptr))
+
+    def edge_id(self, u, v, key=None):
+        """
+        :return: index of edge (u, v, key) in edge arrays, -1 if not in graph
+        """
+        i = self.edge_ids.get((u, v, key), -1)
+        if i == -1 and not self.directed:
+            i = self.edge_ids.get((v, u, key), -1)
+        return i
+
+    def subgraph(self, mask):
+        """
+        induced subgraph based on index mask (no networkx graph is built)
+        :param mask: boolean array (one value per node) or array of node indices
+        :return: CompactGraph
+        """
+        mask = np.asarray(mask)
+        if mask.dtype != bool:
+            ix = mask
+            mask = np.zeros(len(self.ids), dtype=bool)
+            mask[ix] = True
+        new_index = np.full(len(self.ids), -1, dtype=np.int64)
+        new_index[mask] = np.arange(np.count_nonzero(mask))
+
+        sub = copy.copy(self)
+        sub.ids = [n for n, m in zip(self.ids, mask) if m]
+        sub.index = {n: i for i, n in enumerate(sub.ids)}
+        for a in ['x', 'y', 'num_ways', 'delta', 'delta_t']:
+            setattr(sub, a, getattr(self, a)[mask])
+        sub.centralities = {a: v[mask] for a, v in self.centralities.items()}
+
+        edge_mask = mask[self.edge_u] & mask[self.edge_v]
+        new_edge = np.full(len(self.edge_u), -1, dtype=np.int64)
+        new_edge[edge_mask] = np.arange(np.count_nonzero(edge_mask))
+        sub.edge_u, sub.edge_v = new_index[self.edge_u[edge_mask]], new_index[self.edge_v[edge_mask]]
+        sub.edge_key = [k for k, m in zip(self.edge_key, edge_mask) if m]
+        sub.length, sub.bearing = self.length[edge_mask], self.bearing[edge_mask]
+        sub.edge_ids = {(sub.ids[u], sub.ids[v], k): i
+                        for i, (u, v, k) in enumerate(zip(sub.edge_u, sub.edge_v, sub.edge_key))}
+
+        adj_mask = mask[self.adj_source] & mask[self.indices]
+        sub.indices, sub.adj_edge = new_index[self.indices[adj_mask]], new_edge[self.adj_edge[adj_mask]]
+        counts = np.bincount(self.adj_source[adj_mask], minlength=len(self.ids))
+        sub.indptr = np.concatenate([[0], np.cumsum(counts[mask])]).astype(np.int64)
+        return sub
+
+    def to_networkx(self):
+        """
+        :return: networkx graph (copy of source graph, induced by nodes of compact graph)
+        """
+        return self.source.subgraph(self.ids).copy()
+
+
+def _value(value, default):
+    return default if value is None else value
@@ -0,0 +1,130 @@
+import numpy as np
+import networkx as nx
+
+
+def edge_connectivity(compact, s, t):
+    """
+    local edge connectivity (minimum number of edges to remove to disconnect t from s), same value as
+    nx.edge_connectivity(graph, s, t): unit capacity per node pair (parallel edges count once), max flow (dinic) on
+    CSR arrays of the part of the graph which can lie on a path from s to t
+    :param compact: CompactGraph
+    :param s: node id of start node
+    :param t: node id of end node
+    :return: edge connectivity
+    """
+    s, t = _check(compact, s, t)
+    if s == t:
+        raise nx.NetworkXError('source and sink are the same node')
+    u, v = _pairs(compact, self_loops=False)
+    keep = _prune(len(compact), u, v, s, t)
+    if not keep[t]:
+        return 0
+
+    # flow network of remaining nodes
+    index = np.cumsum(keep) - 1
+    both = keep[u] & keep[v]
+    return _max_flow(index[u[both]], index[v[both]], int(keep.sum()), index[s], index[t])
+
+
+def node_connectivity(compact, s, t):
+    """
+    local node connectivity (minimum number of nodes to remove to disconnect t from s), same value as
+    nx.node_connectivity(graph, s, t): node splitting as nx (node i: i_in -> i_out, edge u-v: u_out -> v_in, also
+    edge s-t with capacity 1), max flow from s_out to t_in on the part of the graph which can lie on a path from s to t
+    :param compact: CompactGraph
+    :param s: node id of start node
+    :param t: node id of end node
+    :return: node connectivity
+    """
+    s, t = _check(compact, s, t)
+    u, v = _pairs(compact, self_loops=True)
+
+    # paths from s back to s (s = t) may end at a leaf, only nodes not on any path are removed
+    keep = _prune(len(compact), u, v, s, t) if s != t else np.ones(len(compact), dtype=bool)
+    if not keep[t]:
+        return 0
+
+    # flow network of split nodes: 2 * i (in), 2 * i + 1 (out)
+    index = np.cumsum(keep) - 1
+    n = int(keep.sum())
+    both = keep[u] & keep[v]
+    nodes = np.arange(n)
+    source = np.concatenate([2 * nodes, 2 * index[u[both]] + 1])
+    target = np.concatenate([2 * nodes + 1, 2 * index[v[both]]])
+    return _max_flow(source, target, 2 * n, 2 * index[s] + 1, 2 * index[t])
+
+
+def _check(compact, s, t):
+    # node ids to node indices (errors as nx)
+    for n in [s, t]:
+        if n not in compact.index:
+            raise nx.NetworkXError('node {} not in graph'.format(n))
+    return compact.index[s], compact.index[t]
+
+
+def _pairs(compact, self_loops):
+    # node pairs of all edges (both directions if undirected), parallel edges once
+    u, v = compact.edge_u, compact.edge_v
+    if not compact.directed:
+        u, v = np.concatenate([u, v]), np.concatenate([v, u])
+    if not self_loops:
+        u, v = u[u != v], v[u != v]
+    pairs = np.unique(u * len(compact) + v)
+    return pairs // len(compact), pairs % len(compact)
+
+
+def _prune(n, u, v, s, t):
+    """
+    nodes which can lie on a path from s to t (s != t): trees of degree 1 nodes are removed (a path can not pass
+    through a node with a single neighbour), remaining nodes reachable from s and with t reachable from them
+    :param n: number of nodes
+    :param u: first nodes of node pairs (directed)
+    :param v: second nodes of node pairs
+    :param s: index of start node
+    :param t: index of end node
+    :return: boolean array (one value per node)
+    """
+    import scipy.sparse as sp
+    from scipy.sparse.csgraph import breadth_first_order
+
+    keep = np.ones(n, dtype=bool)
+
+    # undirected neighbours without self-loops
+    loops = u == v
+    pairs = np.unique(np.minimum(u[~loops], v[~loops]) * n + np.maximum(u[~loops], v[~loops]))
+    a, b = np.concatenate([pairs // n, pairs % n]), np.concatenate([pairs % n, pairs // n])
+    order = np.argsort(a, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(a, minlength=n))])
+    nbrs = b[order]
+    degree = np.diff(indptr)
+
+    # peel degree 1 nodes (start and end node remain)
+    stack = [i for i in np.flatnonzero(degree <= 1).tolist() if i != s and i != t]
+    while stack:
+        i = stack.pop()
+        if not keep[i]:
+            continue
+        keep[i] = False
+        for j in nbrs[indptr[i]:indptr[i + 1]].tolist():
+            if keep[j]:
+                degree[j] -= 1
+                if degree[j] <= 1 and j != s and j != t:
+                    stack.append(j)
+
+    # reachable from s and reaching t
+    both = keep[u] & keep[v] & ~loops
+    graph = sp.csr_matrix((np.ones(both.sum(), dtype=np.int8), (u[both], v[both])), shape=(n, n))
+    forward = np.zeros(n, dtype=bool)
+    forward[breadth_first_order(graph, s, directed=True, return_predecessors=False)] = True
+    backward = np.zeros(n, dtype=bool)
+    backward[breadth_first_order(graph.T.tocsr(), t, directed=True, return_predecessors=False)] = True
+    return keep & forward & backward
+
+
+def _max_flow(u, v, n, s, t):
+    # maximum flow value of unit capacity edges u -> v (scipy imported here, slow import)
+    import scipy.sparse as sp
+    from scipy.sparse.csgraph import maximum_flow
+
+    graph = sp.csr_matrix((np.ones(len(u), dtype=np.int32), (u, v)), shape=(n, n))
+    return int(maximum_flow(graph, s, t).flow_value)
@@ -1,9 +1,8 @@
 import pandas as pd
 import numpy as np
-import networkx as nx
-import osmnx as ox
-import copy
-from shapely.geometry import Point
+import re
+from utils.bearing import compass_bearing
+from utils.connectivity import edge_connectivity, node_connectivity
 
 
 def indices(id, graph, polygon, route):
@@ -16,91 +15,157 @@ def indices(id, graph, polygon, route):
     # allowed detour length (50% of the shortest path length)
     detour = sp_length * 0.5
 
-    # minimum node bearing difference to destination (added as attribute to nodes of graph)
-    node_bearing_to_dest_attribute(graph, end)
-    nd_dest = [graph.nodes[n]['min_bearing_to_dest'] for n in graph.nodes]
+    # minimum node bearing difference to destination (array, not stored as node attribute: a subgraph view of nested
+    # extents shares the node attributes of the largest extent)
+    nd_dest = node_bearing_to_dest(graph, end)
 
-    # dictionaries with local centralities (key is node id)
-    cc800 = {n: graph.nodes[n]['cc800'] for n in graph.nodes}
-    cb800 = {n: graph.nodes[n]['cb800'] for n in graph.nodes}
-    cs800 = {n: graph.nodes[n]['cs800'] for n in graph.nodes}
+    # dictionaries with local centralities of all radii present (key is node id), e.g. cc800, cb800, cs800
+    radii = centrality_radii(graph)
+    centralities = {c + str(r): {n: graph.nodes[n][c + str(r)] for n in graph.nodes}
+                    for r in radii for c in ['cc', 'cb', 'cs']}
 
     columns = ['route_id', 'segments', 'intersections', 'area', 'length', 'intersection_density_a',
                'street_density', 'graph_density', 'mean_node_degree', 'mean_segment_length',
                'deadend_perc', 'mean_deadend_length',
                'detour_to_mean_segment_ratio', 'detour_to_mean_deadend_ratio',
                'perc_3_way', 'perc_4_way', 'perc_3_4_way', 'perc_reg_3_way', 'perc_reg_4_way', 'perc_reg_int',
-               'straightness_perc', 'area_circularity', 'orientation_order', 'mean_bearing_to_dest',
-               'mean_cc800', 'mean_cb800', 'mean_cs800',
-               'edge_connectivity', 'node_connectivity',
-               'deadend_start', 'deadend_end',
-               'cc800_start', 'cc800_end',
-               'cb800_start', 'cb800_end',
-               'cs800_start', 'cs800_end']
+               'straightness_perc', 'area_circularity', 'orientation_order', 'mean_bearing_to_dest'] + \
+              ['mean_' + c for c in centralities] + \
+              ['edge_connectivity', 'node_connectivity',
+               'deadend_start', 'deadend_end'] + \
+              [c + p for c in centralities for p in ['_start', '_end']]
 
     # STREET NETWORK PROPERTIES
     route_id = id
-    segments = graph.graph.size()                                           # number of segments []
-    intersections = graph.graph.order()                                     # number of intersections []
+    metrics = network_metrics(graph)                                        # node and edge counts
+    segments = metrics['segments']                                          # number of segments []
+    intersections = metrics['intersections']                                # number of intersections []
     area = polygon.area / 1e6                                               # area [km²]
-    length = graph.graph.size(weight='length_utm_m') / 1e3                  # total street leng[km]
+    length = metrics['length'] / 1e3                                        # total street leng[km]
     intersection_density_a = intersections / area                           # intersection density [# / km²]
     street_density = length / area                                          # street density [km / km²]
     graph_density = ((2 * segments) / (intersections * intersections-1))    # graph density []
-    mean_node_degree = average_node_degree(graph)                           # mean node degree [# edges / # node]
+    mean_node_degree = metrics['mean_node_degree']                          # mean node degree [# edges / # node]
     mean_segment_length = length * 1e3 / segments                           # mean segment length [m]
-    deadend_perc = deadend_percentage(graph)                                # dead end percentage[%]
-    mean_deadend_length = deadend_mean_length(graph)                        # mean dead end segment length [m]
+    deadend_perc = metrics['deadend_perc']                                  # dead end percentage[%]
+    mean_deadend_length = metrics['mean_deadend_length']                    # mean dead end segment length [m]
     detour_to_segment_ratio = detour / mean_segment_length                  # detour to mean segment length ratio [m/m]
     detour_to_deadend_ratio = detour / mean_deadend_length if not np.isnan(mean_deadend_length) else float('NaN')  # detour to mean dead end segment length ratio[m/m]
-    p3, p4, p_3_4_way, p_reg_3, p_reg_4, p_reg_int = intersection_properties(graph)   # intersection percentages [%]
-    straightness_perc = straightness_percentage(graph)                      # straightness percentage [%]
+    p3, p4, p_3_4_way, p_reg_3, p_reg_4, p_reg_int = [metrics[m] for m in [
+        'perc_3_way', 'perc_4_way', 'perc_3_4_way', 'perc_reg_3_way', 'perc_reg_4_way', 'perc_reg_int']]  # intersection percentages [%]
+    straightness_perc = metrics['straightness_perc']                        # straightness percentage [%]
     area_circ = area_circularity(polygon)                                   # area circularity []
     orientation_ord = orientation_order(graph)                              # orientation order []
     mean_node_bearing_to_dest = np.nanmean(nd_dest)                         # mean node bearing to destination []
-    meanCC800 = np.nanmean(list(cc800.values()))                            # mean local closeness centrality []
-    meanCB800 = np.nanmean(list(cb800.values()))                            # mean local betweenness centrality []
-    meanCS800 = np.nanmean(list(cs800.values()))                            # mean local straightness centrality []
+    mean_centralities = [np.nanmean(list(c.values())) for c in centralities.values()]  # mean local closeness, betweenness, straightness centralities per radius []
 
     # START / END NODE PROPERTIES
-    edge_conn = nx.edge_connectivity(graph.graph, start, end)               # edge connectivity, start to end node []
-    node_conn = nx.node_connectivity(graph.graph, start, end)               # node connectivity, start to end node []
+    edge_conn = edge_connectivity(graph.compact, start, end)                # edge connectivity, start to end node []
+    node_conn = node_connectivity(graph.compact, start, end)                # node connectivity, start to end node []
     deadend_start = 1 if graph.nodes[start]['num_ways'] == 1 else 0         # dead end - start node [y/n]
     deadend_end = 1 if graph.nodes[end]['num_ways'] == 1 else 0             # dead end - end node [y/n]
-    cc800_start = cc800[start]                                              # local closeness centrality start node, d=800 []
-    cc800_end = cc800[end]                                                  # local closeness centrality, end node, d=800 []
-    cb800_start = cb800[start]                                              # local betweenness centrality, start node, d=800 []
-    cb800_end = cb800[end]                                                  # local betweenness centrality, end node, d=800 []
-    cs800_start = cs800[start]                                              # local straightness centrality, start node, d=800 []
-    cs800_end = cs800[end]                                                  # local straightness centrality, end node, d=800 []
+    centralities_start_end = [v for c in centralities.values() for v in [c[start], c[end]]]  # local centralities start / end node per radius []
 
     data = [route_id, segments, intersections, area, length, intersection_density_a,
             street_density, graph_density, mean_node_degree, mean_segment_length,
             deadend_perc, mean_deadend_length,
             detour_to_segment_ratio, detour_to_deadend_ratio,
             p3, p4, p_3_4_way, p_reg_3, p_reg_4, p_reg_int,
-            straightness_perc, area_circ, orientation_ord, mean_node_bearing_to_dest,
-            meanCC800, meanCB800, meanCS800,
-            edge_conn, node_conn,
-            deadend_start, deadend_end,
-            cc800_start, cc800_end,
-            cb800_start, cb800_end,
-            cs800_start, cs800_end]
+            straightness_perc, area_circ, orientation_ord, mean_node_bearing_to_dest] + \
+           mean_centralities + \
+           [edge_conn, node_conn,
+            deadend_start, deadend_end] + \
+           centralities_start_end
 
     df = pd.DataFrame([data], columns=columns)
 
     return df
 
 
+def centrality_radii(graph):
+    """
+    :param graph: NetworkGraph
+    :return: sorted radii of local centralities present as node attributes (cc<radius>, cb<radius>, cs<radius>)
+    """
+    names = set()
+    for n in graph.nodes:
+        names.update(a for a in graph.nodes[n] if re.match(r'^c[cbs]\d+$', a))
+    return sorted(r for r in {int(a[2:]) for a in names} if all(c + str(r) in names for c in ['cc', 'cb', 'cs']))
+
+
+def network_metrics(graph, names=None):
+    """
+    counting and summing street network properties of all nodes and edges (arrays of CompactGraph), every metric
+    computed from its own inputs only: node attribute num_ways needed by the node degree, dead end and intersection
+    metrics (KeyError if missing), only the intersection percentages divide by the numbers of 3- / 4-way intersections
+    (ZeroDivisionError as intersection_properties)
+    :param graph: NetworkGraph
+    :param names: metrics to compute (default all): segments, intersections, length [m], mean_node_degree,
+    deadend_perc, intersection percentages (see intersection_properties), straightness_perc, mean_deadend_length
+    :return: dict {metric: value}
+    """
+    c = graph.compact
+    nodes, edges = len(c), len(c.edge_u)
+
+    def num_ways():
+        if (c.num_ways == -1).any():
+            raise KeyError('num_ways')
+        return c.num_ways
+
+    def counts():
+        # dead ends and 3- / 4-way intersections (regular: see Fogliaroni et al. 2018)
+        ways = num_ways()
+        return int((ways == 1).sum()), \
+            int((ways == 3).sum()), int(((ways == 3) & (c.delta_t <= 18)).sum()), \
+            int((ways == 4).sum()), int(((ways == 4) & (c.delta <= 36)).sum())
+
+    def straightness_perc():
+        # straight street segments (same length to mm, no self-loops or junctions None)
+        straight_line = np.sqrt((c.x[c.edge_u] - c.x[c.edge_v]) ** 2 + (c.y[c.edge_u] - c.y[c.edge_v]) ** 2)
+        straight = (c.edge_u != c.edge_v) & (straight_line != 0.0) & (np.abs(straight_line - c.length) < 1e-3)
+        return int(straight.sum()) / edges * 100
+
+    def mean_deadend_length():
+        # dead end segments: first incident edge of dead end node (edge with key 0)
+        deadend_lengths = []
+        for n in np.flatnonzero((num_ways() == 1) & (np.diff(c.indptr) > 0)).tolist():
+            e = c.edge_id(c.ids[n], c.ids[c.indices[c.indptr[n]]], 0)
+            if e != -1:
+                deadend_lengths.append(c.length[e].item())
+        return sum(deadend_lengths) / len(deadend_lengths) if len(deadend_lengths) != 0 else float('NaN')
+
+    def percentages(k):
+        count1way, count3way, count3reg, count4way, count4reg = counts()
+        return [count3way / (nodes - count1way) * 100,
+                count4way / (nodes - count1way) * 100,
+                (count3way + count4way) / (nodes - count1way) * 100,
+                count3reg / count3way * 100,
+                count4reg / count4way * 100,
+                (count3reg + count4reg) / (count3way + count4way) * 100][k]
+
+    metrics = dict(segments=lambda: edges,
+                   intersections=lambda: nodes,
+                   length=lambda: float(c.length.sum()),
+                   mean_node_degree=lambda: int(num_ways().sum()) / nodes,
+                   deadend_perc=lambda: counts()[0] / nodes * 100,
+                   perc_3_way=lambda: percentages(0),
+                   perc_4_way=lambda: percentages(1),
+                   perc_3_4_way=lambda: percentages(2),
+                   perc_reg_3_way=lambda: percentages(3),
+                   perc_reg_4_way=lambda: percentages(4),
+                   perc_reg_int=lambda: percentages(5),
+                   straightness_perc=straightness_perc,
+                   mean_deadend_length=mean_deadend_length)
+    return {name: metrics[name]() for name in (metrics if names is None else names)}
+
+
 def average_node_degree(graph):
     """
     sum of all incident edges divided by the number of nodes in the graph
     :param graph: NetworkGraph
     :return: mean node degree
     """
-    edges = sum([graph.graph.nodes[n]['num_ways'] for n in graph.graph.nodes])
-    mean_degree = edges / graph.graph.order()
-    return mean_degree
+    return network_metrics(graph, ['mean_node_degree'])['mean_node_degree']
 
 
 def straightness_percentage(graph):
@@ -109,17 +174,7 @@ def straightness_percentage(graph):
     :param graph: NetworkGraph
     :return: percentage
     """
-    count = 0
-    for u, v, data in graph.edges(data=True):
-        if u != v:
-            first, last = graph.graph.nodes[u]['geom_utm'], graph.graph.nodes[v]['geom_utm']
-            straightline = first.distance(last)
-            if straightline != 0.0:
-                if np.abs(straightline - data['length_utm_m']) < 1e-3:
-                    count += 1
-
-    percentage = count / graph.graph.size() * 100
-    return percentage
+    return network_metrics(graph, ['straightness_perc'])['straightness_perc']
 
 
 def deadend_percentage(graph):
@@ -128,13 +183,7 @@ def deadend_percentage(graph):
     :param graph: NetworkGraph
     :return: percentage
     """
-    count = 0
-    for n in graph.graph.nodes:
-        if graph.graph.nodes[n]['num_ways'] == 1:
-            count += 1
-
-    percentage = count / graph.graph.order() * 100
-    return percentage
+    return network_metrics(graph, ['deadend_perc'])['deadend_perc']
 
 
 def intersection_properties(graph):
@@ -144,31 +193,10 @@ def intersection_properties(graph):
     :param graph: NetworkGraph
     :return: 3-way, 4-way, 3+4-way intersection percentage, regular 3-way, 4-way, 3+4-way intersection percentage
     """
-    count1way = 0
-    count3way, count3reg = 0, 0
-    count4way, count4reg = 0, 0
-    for n in graph.graph.nodes:
-        if graph.graph.nodes[n]['num_ways'] == 1:
-            count1way += 1
-        if graph.graph.nodes[n]['num_ways'] == 3:
-            count3way += 1
-            if graph.graph.nodes[n]['delta_t'] <= 18:
-                count3reg += 1
-        elif graph.graph.nodes[n]['num_ways'] == 4:
-            count4way += 1
-            if graph.graph.nodes[n]['delta'] <= 36:
-                count4reg += 1
-
-    percentage_3_way = (count3way) / (len(graph.nodes)-count1way) * 100
-    percentage_4_way = (count4way) / (len(graph.nodes)-count1way) * 100
-    percentage_3_4_way = (count3way + count4way) / (len(graph.nodes) - count1way) * 100
-
-    percentage_regular_3_ways = count3reg / count3way * 100
-    percentage_regular_4_ways = count4reg / count4way * 100
-    percentage_regular_3_4_way = (count3reg + count4reg) / (count3way + count4way) * 100
-
-    return percentage_3_way, percentage_4_way, percentage_3_4_way, \
-           percentage_regular_3_ways, percentage_regular_4_ways, percentage_regular_3_4_way
+    m = network_metrics(graph, ['perc_3_way', 'perc_4_way', 'perc_3_4_way', 'perc_reg_3_way', 'perc_reg_4_way',
+                                'perc_reg_int'])
+    return m['perc_3_way'], m['perc_4_way'], m['perc_3_4_way'], \
+           m['perc_reg_3_way'], m['perc_reg_4_way'], m['perc_reg_int']
 
 
 def area_circularity(polygon):
@@ -181,66 +209,78 @@ def area_circularity(polygon):
     return r
 
 
-def orientation_order(graph):
+def orientation_order(graph, num_bins=36, weighted=False):
     """
-    (see Boeing, G. 2018)
-    :param graph: NetworkGraph.graph (with edge attribute "bearing")
-    :return: phi (orientation order)
+    (see Boeing, G. 2018), entropy of edge bearings and their reverse directions (as osmnx.orientation_entropy)
+    from bearing and length arrays of CompactGraph (no copy of graph)
+    :param graph: NetworkGraph (with edge attribute "bearing")
+    :param num_bins: number of bins of bearing histogram
+    :param weighted: True to weight bearings by edge length (default: edge count as osmnx)
+    :return: phi (orientation order), NaN without any usable edge
     """
-    g = copy.deepcopy(graph)
-    g.graph.graph['crs'] = 4326
-    for u, v, data in g.edges(data=True):
-        data["length"] = data.pop("length_utm_m")
-    H0 = ox.orientation_entropy(g.graph)
+    H0 = orientation_entropy(graph, num_bins, weighted)
     Hmax = 3.584
     Hgrid = 1.386
     phi = 1 - ((H0 - Hgrid) / (Hmax - Hgrid)) ** 2
     return phi
 
 
+def orientation_entropy(graph, num_bins=36, weighted=False):
+    """
+    entropy of bearing histogram (self-loops, edges without length and junction None are ignored)
+    :param graph: NetworkGraph (with edge attribute "bearing")
+    :param num_bins: number of bins of bearing histogram (first bin centered on north)
+    :param weighted: True to weight bearings by edge length
+    :return: entropy [nats], NaN without any usable edge (as scipy.stats.entropy)
+    """
+    c = graph.compact
+    keep = (c.edge_u != c.edge_v) & (c.length >= 0) & ~np.isnan(c.bearing)
+    bearings = c.bearing[keep]
+    weights = np.tile(c.length[keep], 2) if weighted else None
+
+    # twice the number of bins, rolled by one and merged pairwise (first bin from -5° to 5° for 36 bins)
+    bins = np.arange(num_bins * 2 + 1) * 360 / (num_bins * 2)
+    count, _ = np.histogram(np.concatenate([bearings, (bearings - 180) % 360]), bins=bins, weights=weights)
+    count = np.roll(count, 1)
+    count = count[::2] + count[1::2]
+
+    if np.sum(count) == 0:
+        return np.nan
+    p = count / np.sum(count)
+    return np.sum(np.where(p > 0, -p * np.log(np.where(p > 0, p, 1.0)), 0.0))
+
+
+def node_bearing_to_dest(graph, destination):
+    """
+    minimum difference of bearing to destination and bearing of incident edges of all nodes within graph
+    (incidence bearings cached on graph)
+    :param graph: NetworkGraph
+    :param destination: node id of route destination
+    :return: array of minimum bearing differences (in order of compact graph, NaN for nodes without incident edge)
+    """
+    c = graph.compact
+    node, _, bearing = graph.incidence_bearings
+    dest = c.index[destination]
+    bearing_dest = compass_bearing(c.x, c.y, c.x[dest], c.y[dest])
+
+    diffs = np.abs(bearing_dest[node] - bearing)
+    diffs = np.minimum(diffs, 360 - diffs)
+    min_diffs = np.full(len(c), np.inf)
+    np.fmin.at(min_diffs, node, diffs)
+    min_diffs[np.isinf(min_diffs)] = np.nan
+    return min_diffs
+
+
 def node_bearing_to_dest_attribute(graph, destination):
     """
-    function to add node attribute "min_bearing_to_dest" to all nodes within graph
+    function to add node attribute "min_bearing_to_dest" to all nodes within graph (see node_bearing_to_dest, not for
+    subgraph views: attributes are written to the nodes of the parent graph)
     :param graph: NetworkGraph
     :param destination: node id of route destination
     :return:
     """
-    dest = graph.nodes[destination]['geom_utm']
-
-    for n in graph.nodes:
-        node = graph.nodes[n]['geom_utm']
-        bearing_dest = (90 - np.rad2deg(np.arctan2(dest.y - node.y, dest.x - node.x))) % 360
-        diffs = []
-        for e in graph.edges(n):
-            node_adj = graph.nodes[e[1]]['geom_utm']
-            dist_straight = node.distance(node_adj)
-            if dist_straight == 0.0:
-                pass
-            elif np.abs(dist_straight - graph.graph[n][e[1]][0]['length_utm_m']) < 1e-3:
-                bearing_node_adj = (90 - np.rad2deg(np.arctan2(node_adj.y - node.y, node_adj.x - node.x))) % 360
-                diffs.append(
-                    min(np.abs(bearing_dest - bearing_node_adj), 360 - np.abs(bearing_dest - bearing_node_adj)))
-            else:
-                line_nodes = []
-                try:
-                    l_multiline = len(graph.graph[n][e[1]][0]['geom_utm'].geoms)
-                    for l in graph.graph[n][e[1]][0]['geom_utm'].geoms:
-                        line_nodes.extend(l.coords)
-                except:
-                    line_nodes.extend(graph.graph[n][e[1]][0]['geom_utm'].coords)
-
-                dists, points = [], []
-                for coords in line_nodes:
-                    dist = node.distance(Point(coords))
-                    if dist != 0:
-                        dists.append(dist)
-                        points.append(coords)
-                closest_node = Point(points[np.argmin(dists)])
-                bearing_node_adj = (90 - np.rad2deg(np.arctan2(closest_node.y - node.y, closest_node.x - node.x))) % 360
-                diffs.append(
-                    min(np.abs(bearing_dest - bearing_node_adj), 360 - np.abs(bearing_dest - bearing_node_adj)))
-
-        graph.nodes[n]['min_bearing_to_dest'] = min(diffs) if len(diffs) != 0 else float('NaN')
+    for n, d in zip(graph.compact.ids, node_bearing_to_dest(graph, destination).tolist()):
+        graph.nodes[n]['min_bearing_to_dest'] = d
 
 
 def deadend_mean_length(graph):
@@ -249,18 +289,4 @@ def deadend_mean_length(graph):
     :param graph: NetworkGraph
     :return: mean dead end segment length
     """
-    deadend_count = 0
-    deadend_total_l = 0
-    for n in graph.nodes:
-        if graph.nodes[n]['num_ways'] == 1:
-            try:
-                u, v = list(graph.edges([n]))[0][0], list(graph.edges([n]))[0][1]
-                deadend_total_l += graph.graph[u][v][0]['length_utm_m']
-                deadend_count += 1
-            except:
-                pass
-    if deadend_count != 0:
-        deadend_length = deadend_total_l / deadend_count
-    else:
-        deadend_length = float('NaN')
-    return deadend_length
+    return network_metrics(graph, ['mean_deadend_length'])['mean_deadend_length']
@@ -0,0 +1,334 @@
+import os
+import json
+import pickle
+import numpy as np
+import networkx as nx
+from shapely import wkb
+from shapely.geometry import Point, LineString, MultiLineString
+from shapely.geometry.base import BaseGeometry
+import shapely
+
+# vectorized geometry creation (shapely >= 2.0)
+_vectorized = hasattr(shapely, 'points')
+
+# graph store: folder (*.graph) with columnar node / edge tables
+# - meta.json with graph type and column kinds
+# - bool, int, float and str attributes as .npy arrays if all values have the same type (mask if not present for all
+#   nodes / edges), mixed types pickled
+# - point and (multi)linestring geometries as coordinate arrays with offsets, geometry objects built when the graph is
+#   read (vectorized with shapely >= 2.0, one by one with shapely < 2.0), edge geometries optional (edge_geometries)
+# - other geometries as WKB
+# - still pickled: columns of mixed types or other attributes (per column) and the graph attributes (graph.pkl)
+
+
+def is_graph_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+
+def find_graph(folder, name):
+    """
+    path of graph in folder containing name, graph store preferred over pickled graph
+    :param folder: folder to search
+    :param name: part of file name (e.g. 'nx_graph_with_ec_with_bearing')
+    :return: path of graph
+    """
+    files = sorted([f for f in os.listdir(folder) if name in f], key=lambda f: not f.endswith('.graph'))
+    return os.path.join(folder, files[0])
+
+
+def legacy_path(path):
+    """
+    pickled file of earlier versions (*.p, e.g. existing 02_Subgraphs trees) if only that exists instead of the graph
+    store (*.graph) or polygon (*.wkb)
+    :param path: path of graph store or polygon
+    :return: path of existing file
+    """
+    legacy = os.path.splitext(path)[0] + '.p'
+    if not os.path.exists(path) and os.path.exists(legacy):
+        return legacy
+    return path
+
+
+def read_meta(path):
+    """
+    :param path: graph store folder (*.graph) or pickled graph (*.p)
+    :return: dict with graph type and number of nodes / edges (nr_nodes, nr_edges)
+    """
+    path = legacy_path(path)
+    if not is_graph_store(path):
+        graph = nx.read_gpickle(path)
+        return dict(directed=graph.is_directed(), multigraph=graph.is_multigraph(),
+                    nr_nodes=graph.number_of_nodes(), nr_edges=graph.number_of_edges())
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+
+def write_graph(graph, path):
+    """
+    store networkx graph as graph store (folder)
+    :param graph: networkx graph (NetworkGraph.graph)
+    :param path: output folder (*.graph)
+    :return:
+    """
+    write_subgraphs(graph, [None], [path])
+
+
+def write_subgraphs(graph, nodes, paths):
+    """
+    store induced subgraphs of a networkx graph as graph stores: columns of the graph built once and sliced per
+    subgraph (e.g. nested area extents of a route), nodes and edges kept in order of the graph
+    :param graph: networkx graph (NetworkGraph.graph)
+    :param nodes: list of node positions (in order of graph) per subgraph, None for the whole graph
+    :param paths: list of output folders (*.graph)
+    :return:
+    """
+    multigraph = graph.is_multigraph()
+    ids = list(graph)
+    index = {n: i for i, n in enumerate(ids)}
+    edges = list(graph.edges(keys=True, data=True)) if multigraph else \
+        [(u, v, None, d) for u, v, d in graph.edges(data=True)]
+    edge_u = np.array([index[e[0]] for e in edges], dtype=np.int64)
+    edge_v = np.array([index[e[1]] for e in edges], dtype=np.int64)
+
+    id_column = _encode_column(ids, [True] * len(ids))
+    key_column = _encode_column([e[2] for e in edges], [True] * len(edges))
+    node_data = [graph.nodes[n] for n in ids]
+    node_columns = {name: _encode_column([d.get(name) for d in node_data], [name in d for d in node_data])
+                    for name in _attribute_names(node_data)}
+    edge_data = [e[3] for e in edges]
+    edge_columns = {name: _encode_column([d.get(name) for d in edge_data], [name in d for d in edge_data])
+                    for name in _attribute_names(edge_data)}
+
+    for sel, path in zip(nodes, paths):
+        # overwrite existing graph store
+        if is_graph_store(path):
+            for f in os.listdir(path):
+                os.remove(os.path.join(path, f))
+        os.makedirs(path, exist_ok=True)
+
+        # induced subgraph: edges with both nodes selected, node positions renumbered
+        if sel is None:
+            sel, edge_sel, renumber = np.arange(len(ids)), np.arange(len(edges)), np.arange(len(ids))
+        else:
+            sel = np.asarray(sel, dtype=np.int64)
+            renumber = np.full(len(ids), -1, dtype=np.int64)
+            renumber[sel] = np.arange(len(sel))
+            edge_sel = np.flatnonzero((renumber[edge_u] >= 0) & (renumber[edge_v] >= 0))
+
+        meta = dict(directed=graph.is_directed(), multigraph=multigraph, nr_nodes=len(sel), nr_edges=len(edge_sel),
+                    node_columns={}, edge_columns={})
+        meta['ids'] = _write_column(path, 'ids', id_column, sel)
+        meta['keys'] = _write_column(path, 'keys', key_column, edge_sel)
+        np.save(os.path.join(path, 'edge_u.npy'), renumber[edge_u[edge_sel]])
+        np.save(os.path.join(path, 'edge_v.npy'), renumber[edge_v[edge_sel]])
+
+        # attributes of none of the selected nodes / edges are left out
+        for name, column in node_columns.items():
+            if column['present'][sel].any():
+                meta['node_columns'][name] = _write_column(path, 'node_' + name, column, sel)
+        for name, column in edge_columns.items():
+            if column['present'][edge_sel].any():
+                meta['edge_columns'][name] = _write_column(path, 'edge_' + name, column, edge_sel)
+
+        with open(os.path.join(path, 'graph.pkl'), 'wb') as f:
+            pickle.dump(dict(graph.graph), f)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+
+def load_arrays(path, mmap_mode='r'):
+    """
+    load all arrays of graph store without building a graph (memory-mapped by default)
+    :param path: graph store folder (*.graph)
+    :param mmap_mode: numpy memory-map mode, None to read arrays into memory
+    :return: dict {array name: array}
+    """
+    return {f[:-4]: np.load(os.path.join(path, f), mmap_mode=mmap_mode)
+            for f in os.listdir(path) if f.endswith('.npy')}
+
+
+def read_graph(path, mmap_mode=None, edge_geometries=True):
+    """
+    read graph store as networkx graph
+    :param path: graph store folder (*.graph)
+    :param mmap_mode: numpy memory-map mode of arrays (e.g. 'r')
+    :param edge_geometries: False to leave out edge geometries (linestrings and WKB columns are not read): for graphs
+    of which only node coordinates, edge lengths or the CSR adjacency are needed, not for graphs written again
+    :return: networkx graph
+    """
+    meta = read_meta(path)
+    arrays = load_arrays(path, mmap_mode=mmap_mode)
+
+    if meta['multigraph']:
+        graph = nx.MultiDiGraph() if meta['directed'] else nx.MultiGraph()
+    else:
+        graph = nx.DiGraph() if meta['directed'] else nx.Graph()
+    with open(os.path.join(path, 'graph.pkl'), 'rb') as f:
+        graph.graph.update(pickle.load(f))
+
+    ids = _read_column(path, 'ids', meta['ids'], arrays, meta['nr_nodes'])[0]
+    node_data = [{} for _ in range(meta['nr_nodes'])]
+    for name, kind in meta['node_columns'].items():
+        _fill(node_data, name, *_read_column(path, 'node_' + name, kind, arrays, meta['nr_nodes']))
+    graph.add_nodes_from(zip(ids, node_data))
+
+    keys = _read_column(path, 'keys', meta['keys'], arrays, meta['nr_edges'])[0]
+    edge_data = [{} for _ in range(meta['nr_edges'])]
+    for name, kind in meta['edge_columns'].items():
+        if kind['kind'] in ['line', 'wkb'] and not edge_geometries:
+            continue
+        _fill(edge_data, name, *_read_column(path, 'edge_' + name, kind, arrays, meta['nr_edges']))
+    u, v = [ids[i] for i in arrays['edge_u']], [ids[i] for i in arrays['edge_v']]
+    if meta['multigraph']:
+        graph.add_edges_from(zip(u, v, keys, edge_data))
+    else:
+        graph.add_edges_from(zip(u, v, edge_data))
+    return graph
+
+
+def write_polygon(polygon, path):
+    with open(path, 'wb') as f:
+        f.write(polygon.wkb)
+
+
+def read_polygon(path):
+    path = legacy_path(path)
+    with open(path, 'rb') as f:
+        return pickle.load(f) if path.endswith('.p') else wkb.loads(f.read())
+
+
+# value types stored as arrays (see _encode_column)
+_array_types = {bool: bool, int: np.int64, float: np.float64, str: np.str_,
+                np.bool_: np.bool_, np.int32: np.int32, np.int64: np.int64, np.float32: np.float32,
+                np.float64: np.float64, np.str_: np.str_}
+
+
+def _attribute_names(data):
+    names = {}
+    for d in data:
+        for name in d:
+            names[name] = None
+    return list(names)
+
+
+def _encode_column(values, present):
+    present = np.array(present, dtype=bool)
+    vals = [v for v, p in zip(values, present) if p]
+
+    # bools, ints, floats or strings: one array per column if all values have the same type (types kept exactly,
+    # numpy scalars read back as numpy scalars), mixed columns pickled
+    types = {type(v) for v in vals}
+    t = types.pop() if len(types) == 1 else None
+    if t in _array_types and not (t is int and not all(-2 ** 63 <= v < 2 ** 63 for v in vals)):
+        default = t('') if issubclass(t, str) else t(0)
+        arr = np.array([v if p else default for v, p in zip(values, present)], dtype=_array_types[t])
+        return dict(kind='number' if t in [bool, int, float] else 'str' if t is str else 'numpy', present=present,
+                    arrays={'': arr})
+
+    # 2D points / (multi)linestrings as coordinate arrays, other geometries as WKB
+    if len(vals) != 0 and all(isinstance(v, BaseGeometry) for v in vals):
+        if all(isinstance(v, Point) and not v.is_empty and not v.has_z for v in vals):
+            xy = np.zeros((len(values), 2), dtype=np.float64)
+            xy[present] = [(v.x, v.y) for v in vals]
+            return dict(kind='point', present=present, arrays={'_xy': xy})
+        if all(isinstance(v, (LineString, MultiLineString)) and not v.is_empty and not v.has_z for v in vals):
+            coords, part_offsets, geom_offsets, multi = [], [0], [0], []
+            for v, p in zip(values, present):
+                parts = (list(v.geoms) if isinstance(v, MultiLineString) else [v]) if p else []
+                for line in parts:
+                    coords.append(np.asarray(line.coords, dtype=np.float64)[:, :2])
+                    part_offsets.append(part_offsets[-1] + len(line.coords))
+                geom_offsets.append(geom_offsets[-1] + len(parts))
+                multi.append(isinstance(v, MultiLineString))
+            return dict(kind='line', present=present,
+                        arrays={'_coords': np.concatenate(coords) if coords else np.zeros((0, 2)),
+                                '_part_offsets': np.array(part_offsets, dtype=np.int64),
+                                '_geom_offsets': np.array(geom_offsets, dtype=np.int64),
+                                '_multi': np.array(multi, dtype=bool)})
+        return dict(kind='wkb', present=present, values=[v.wkb if p else None for v, p in zip(values, present)])
+
+    # any other attribute
+    return dict(kind='object', present=present, values=list(values))
+
+
+def _ranges(starts, counts):
+    # positions starts[i], ..., starts[i] + counts[i] - 1 of all ranges
+    ends = np.cumsum(counts)
+    return np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def _write_column(path, name, column, sel):
+    # values of an encoded column at positions sel (in order of sel)
+    present = column['present'][sel]
+    if not present.all():
+        np.save(os.path.join(path, name + '_mask.npy'), present)
+
+    if column['kind'] == 'line':
+        coords, part_offsets, geom_offsets, multi = [column['arrays'][k] for k in
+                                                     ['_coords', '_part_offsets', '_geom_offsets', '_multi']]
+        nr_parts = geom_offsets[sel + 1] - geom_offsets[sel]
+        parts = _ranges(geom_offsets[sel], nr_parts)
+        nr_coords = part_offsets[parts + 1] - part_offsets[parts]
+        arrays = {'_coords': coords[_ranges(part_offsets[parts], nr_coords)],
+                  '_part_offsets': np.concatenate([[0], np.cumsum(nr_coords)]).astype(np.int64),
+                  '_geom_offsets': np.concatenate([[0], np.cumsum(nr_parts)]).astype(np.int64),
+                  '_multi': multi[sel]}
+    elif 'arrays' in column:
+        arrays = {k: arr[sel] for k, arr in column['arrays'].items()}
+    else:
+        arrays = {}
+        with open(os.path.join(path, name + '.pkl'), 'wb') as f:
+            pickle.dump([column['values'][i] for i in sel], f)
+    for k, arr in arrays.items():
+        np.save(os.path.join(path, name + k + '.npy'), arr)
+    return dict(kind=column['kind'], mask=not present.all())
+
+
+def _read_column(path, name, kind, arrays, length):
+    present = arrays[name + '_mask'] if kind['mask'] else None
+
+    if kind['kind'] in ['number', 'str']:
+        values = arrays[name].tolist()
+    elif kind['kind'] == 'numpy':
+        values = list(np.asarray(arrays[name]))
+    elif kind['kind'] == 'point':
+        xy = np.asarray(arrays[name + '_xy'])
+        values = list(shapely.points(xy)) if _vectorized else [Point(x, y) for x, y in xy]
+    elif kind['kind'] == 'line':
+        values = _lines(arrays[name + '_coords'], arrays[name + '_part_offsets'],
+                        arrays[name + '_geom_offsets'], arrays[name + '_multi'], present)
+    else:
+        with open(os.path.join(path, name + '.pkl'), 'rb') as f:
+            values = pickle.load(f)
+        if kind['kind'] == 'wkb':
+            values = [wkb.loads(v) if v is not None else None for v in values]
+    return values, present
+
+
+def _lines(coords, part_offsets, geom_offsets, multi, present):
+    coords, part_offsets, geom_offsets = np.asarray(coords), np.asarray(part_offsets), np.asarray(geom_offsets)
+    if _vectorized:
+        part_index = np.repeat(np.arange(len(part_offsets) - 1), np.diff(part_offsets))
+        lines = shapely.linestrings(coords, indices=part_index)
+    else:
+        lines = [LineString(coords[part_offsets[i]:part_offsets[i + 1]]) for i in range(len(part_offsets) - 1)]
+
+    values = []
+    for i in range(len(geom_offsets) - 1):
+        if present is not None and not present[i]:
+            values.append(None)
+        elif multi[i]:
+            values.append(MultiLineString(list(lines[geom_offsets[i]:geom_offsets[i + 1]])))
+        else:
+            values.append(lines[geom_offsets[i]])
+    return values
+
+
+def _fill(data, name, values, present):
+    if present is None:
+        for d, v in zip(data, values):
+            d[name] = v
+    else:
+        for d, v, p in zip(data, values, present):
+            if p:
+                d[name] = v
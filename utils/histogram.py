@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class CountingHistogram():
+    """
+    exact counting histogram of values rounded to a fixed number of decimals
+    (memory bounded by the number of distinct values, histograms can be merged)
+    """
+    def __init__(self, decimals=6):
+        self.scale = 10 ** decimals
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self._pending = []
+        self._pending_size = 0
+
+    def add(self, values):
+        """
+        :param values: array of values (NaN is ignored)
+        :return:
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        self._pending.append(np.rint(values * self.scale).astype(np.int64))
+        self._pending_size += len(values)
+        if self._pending_size > 1e6:
+            self._compact()
+
+    def merge(self, other):
+        other._compact()
+        self._add_counts(other.keys, other.counts)
+
+    def __len__(self):
+        self._compact()
+        return int(self.counts.sum())
+
+    def value(self, k):
+        """
+        :param k: rank (0 is the smallest value, negative ranks count from the largest value)
+        :return: k-th smallest value
+        """
+        self._compact()
+        cum = np.cumsum(self.counts)
+        if k < 0:
+            k += cum[-1] if len(cum) != 0 else 0
+        if k < 0 or len(cum) == 0 or k >= cum[-1]:
+            raise IndexError('rank out of range')
+        return self.keys[np.searchsorted(cum, k, side='right')] / self.scale
+
+    def quantile(self, q):
+        """
+        quantile with linear interpolation (as numpy.quantile)
+        :param q: probability [0 - 1]
+        :return: quantile
+        """
+        n = len(self)
+        if n == 0:
+            return float('NaN')
+        index = q * (n - 1)
+        lo, hi = int(np.floor(index)), int(np.ceil(index))
+        v_lo, v_hi, t = self.value(lo), self.value(hi), index - lo
+        # same interpolation as numpy (stable for t >= 0.5)
+        return v_lo + (v_hi - v_lo) * t if t < 0.5 else v_hi - (v_hi - v_lo) * (1 - t)
+
+    def _compact(self):
+        if len(self._pending) != 0:
+            keys, counts = np.unique(np.concatenate(self._pending), return_counts=True)
+            self._pending, self._pending_size = [], 0
+            self._add_counts(keys, counts)
+
+    def _add_counts(self, keys, counts):
+        keys, inverse = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+        self.counts = np.bincount(inverse, weights=np.concatenate([self.counts, counts])).astype(np.int64)
+        self.keys = keys
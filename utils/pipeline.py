@@ -0,0 +1,369 @@
+import os
+import io
+import json
+import time
+import inspect
+import hashlib
+import contextlib
+import multiprocessing as mp
+
+from utils.processing import *
+from utils.workers import init_worker, worker_graph, worker_routes
+from utils.graph_store import find_graph, legacy_path
+
+# pipeline of the preprocessing and analysis stages:
+# - every stage knows its inputs and outputs per route (path templates relative to the data folder)
+# - fingerprint of a route = stage parameters + content hash of all inputs + code of the stage (task and modules)
+# - fingerprints stored as manifest per stage and route (<data>/.pipeline/<city>/<stage>/route_XX.json)
+# - only routes with missing outputs or changed fingerprint are recomputed (in parallel)
+# - failed routes are skipped by the following stages, the run raises an error after all stages
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GRAPH = '{graph}'
+ROUTES = '{routes}'
+DATASET = '{dataset}'
+
+# source files of the stages (relative to ROOT), part of the fingerprints
+CLIPPING_CODE = ['utils/processing.py', 'utils/area_definitions.py', 'utils/utils.py', 'utils/compact.py',
+                 'utils/graph_store.py']
+CENTRALITY_CODE = ['utils/processing.py', 'utils/centrality.py', 'utils/utils.py', 'utils/compact.py',
+                   'utils/graph_store.py']
+PROPERTIES_CODE = ['streetnetworkproperties.py', 'utils/graph_indices.py', 'utils/connectivity.py', 'utils/bearing.py',
+                   'utils/utils.py', 'utils/compact.py', 'utils/graph_store.py']
+REGRESSION_CODE = ['regression.py', 'utils/utils.py']
+
+
+class Stage():
+    """
+    stage of the pipeline
+    :param name: name of stage (e.g. 'clipping_big')
+    :param task: module level function task(routeid, city, path_data, **params)
+    :param inputs: list of path templates ({name}: city name, {route}: route id, {graph}/{routes}: original files)
+    :param outputs: list of path templates
+    :param params: parameters of task (part of fingerprint)
+    :param per_route: False if stage runs once over all routes (inputs expanded over all route ids)
+    :param graph: True if task needs the city graph (loaded once per worker)
+    :param code: list of source files of the task (relative to ROOT, part of fingerprint together with the task)
+    """
+    def __init__(self, name, task, inputs, outputs, params=None, per_route=True, graph=False, code=()):
+        self.name = name
+        self.task = task
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params if params is not None else {}
+        self.per_route = per_route
+        self.graph = graph
+        self.code = list(code)
+
+
+def stages(radius=800, thresholds=None, extents=('big', 'medium', 'small'), oneshot=False):
+    """
+    stages of the pipeline (clipping boundingbox -> subgraphs -> centralities -> big/medium/small -> properties
+    -> regression)
+    :param radius: radius of local centralities
+    :param thresholds: node ratio thresholds per extent (default EXTENT_THRESHOLDS)
+    :param extents: area extents to compute
+    :param oneshot: True to clip the subgraphs in one step without boundingbox graphs (node ratios of qualifying
+    nodes only in subgraphs/node_ratios, see bounded_node_lengths)
+    :return: list of stages
+    """
+    thresholds = dict(EXTENT_THRESHOLDS, **(thresholds if thresholds is not None else {}))
+    sub = os.path.join('02_Subgraphs', '{city}')
+    graph = os.path.join(sub, '{dir}', '{name}_nx_graph_{route:02d}.graph')
+    node_ratios = os.path.join(sub, 'subgraphs' if oneshot else 'boundingbox', 'node_ratios', 'route_{route:02d}.csv')
+
+    if oneshot:
+        s = [Stage('clipping_subgraphs', clipping, [GRAPH, ROUTES],
+                   [graph.replace('{dir}', 'subgraphs'), node_ratios],
+                   params=dict(size='subgraphs_oneshot', thresh=thresholds['big']), graph=True,
+                   code=CLIPPING_CODE)]
+    else:
+        s = [Stage('clipping_boundingbox', clipping, [GRAPH, ROUTES],
+                   [graph.replace('{dir}', 'boundingbox'), node_ratios],
+                   params=dict(size='boundingbox'), graph=True, code=CLIPPING_CODE),
+             Stage('clipping_subgraphs', clipping, [GRAPH, ROUTES, node_ratios],
+                   [graph.replace('{dir}', 'subgraphs')],
+                   params=dict(size='subgraphs', thresh=thresholds['big']), graph=True, code=CLIPPING_CODE)]
+    s += [Stage('centralities', centralities, [graph.replace('{dir}', 'subgraphs')],
+                [graph.replace('{dir}', 'subgraphs_with_centralities')],
+                params=dict(radius=radius), code=CENTRALITY_CODE)]
+
+    for extent in extents:
+        properties = os.path.join('03_StreetNetworkProperties', extent, '{name}_properties_{route:02d}.csv')
+        s += [Stage('clipping_' + extent, clipping,
+                    [GRAPH, ROUTES, node_ratios, graph.replace('{dir}', 'subgraphs_with_centralities')],
+                    [graph.replace('{dir}', extent), os.path.join(sub, extent, '{name}_polygon_{route:02d}.wkb')],
+                    params=dict(size=extent, thresh=thresholds[extent], oneshot=oneshot), graph=True,
+                    code=CLIPPING_CODE),
+              Stage('properties_' + extent, properties_task,
+                    [ROUTES, graph.replace('{dir}', extent),
+                     os.path.join(sub, extent, '{name}_polygon_{route:02d}.wkb')],
+                    [properties], params=dict(extent=extent), code=PROPERTIES_CODE),
+              Stage('regression_' + extent, regression_task, [properties, DATASET],
+                    [os.path.join('03_StreetNetworkProperties', 'regression_{name}_' + extent + '.txt')],
+                    params=dict(size=extent), per_route=False, code=REGRESSION_CODE)]
+    return s
+
+
+# TASKS
+def clipping(routeid, city, path_data, size, thresh=None, oneshot=None):
+    path_sub = os.path.join(path_data, '02_Subgraphs', city)
+    graph_clipping(routeid, city, worker_graph(), worker_routes(), path_sub, size, thresh=thresh, oneshot=oneshot)
+
+
+def centralities(routeid, city, path_data, radius):
+    local_centrality_computation(routeid, city, os.path.join(path_data, '02_Subgraphs', city), radius)
+
+
+def properties_task(routeid, city, path_data, extent):
+    from streetnetworkproperties import network_properties
+    network_properties(routeid, city, extent, path_data)
+
+
+def regression_task(routeid, city, path_data, size):
+    from regression import regression_data, principal_component_regression
+    properties = regression_data([city], size, path_data)
+
+    # printed regression results stored as text file
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        principal_component_regression(properties, city, size, path_data)
+    path_out = os.path.join(path_data, '03_StreetNetworkProperties', 'regression_{:s}_{:s}.txt'.format(
+        city[3:].lower(), size))
+    with open(path_out, 'w') as f:
+        f.write(out.getvalue())
+
+
+class Pipeline():
+    """
+    runs stale routes of all stages of one city
+    :param city: city (01_Vienna, 02_Mexico, 03_Djibouti)
+    :param path_data: data folder (01_Data)
+    :param stages: list of stages (see stages())
+    :param routeids: route ids
+    :param processes: number of worker processes
+    """
+    def __init__(self, city, path_data, stages, routeids=range(100), processes=None):
+        self.city = city
+        self.path_data = path_data
+        self.stages = order_stages(stages)
+        self.routeids = list(routeids)
+        self.processes = processes if processes is not None else max(int(mp.cpu_count() - 1), 1)
+
+        path_orig = os.path.join(path_data, '01_Original', city)
+        self.path_graph = find_graph(path_orig, 'nx_graph_with_ec_with_bearing')
+        self.path_routes = os.path.join(path_orig, [f for f in os.listdir(path_orig) if 'random_routes' in f][0])
+        self.path_manifest = os.path.join(path_data, '.pipeline', city)
+        self.hashes = FileHashes(os.path.join(path_data, '.pipeline', 'hashes.json'))
+        self._pools = {}
+        self._code = {}
+
+    def path(self, template, routeid=None):
+        if template == GRAPH:
+            return self.path_graph
+        if template == ROUTES:
+            return self.path_routes
+        if template == DATASET:
+            from regression import regression_dataset
+            return regression_dataset(self.path_data, self.city)
+        return os.path.join(self.path_data, template.format(city=self.city, name=self.city[3:].lower(), route=routeid))
+
+    def inputs(self, stage, routeid):
+        # pickled graphs / polygons of earlier versions used as inputs if no graph store / wkb file exists
+        if stage.per_route:
+            return [legacy_path(self.path(t, routeid)) for t in stage.inputs]
+        return [legacy_path(self.path(t, r) if '{route' in t else self.path(t)) for t in stage.inputs for r in
+                (self.routeids if '{route' in t else [None])]
+
+    def outputs(self, stage, routeid):
+        return [self.path(t, routeid) for t in stage.outputs]
+
+    def fingerprint(self, stage, routeid):
+        """
+        :return: fingerprint of stage and route (parameters, code of stage and content of inputs), None if an input
+        is missing
+        """
+        h = hashlib.sha256(json.dumps(dict(stage=stage.name, params=stage.params), sort_keys=True).encode())
+        h.update(self.code(stage).encode())
+        for path in self.inputs(stage, routeid):
+            if not os.path.exists(path):
+                return None
+            h.update(os.path.basename(path).encode())
+            h.update(self.hashes.get(path).encode())
+        return h.hexdigest()
+
+    def code(self, stage):
+        """
+        :return: hash of the source of the task and of the source files of the stage (once per stage)
+        """
+        if stage.name not in self._code:
+            h = hashlib.sha256(inspect.getsource(stage.task).encode())
+            for file in stage.code:
+                h.update(file.encode())
+                h.update(self.hashes.get(os.path.join(ROOT, file)).encode())
+            self._code[stage.name] = h.hexdigest()
+        return self._code[stage.name]
+
+    def manifest(self, stage, routeid):
+        name = 'route_{:02d}.json'.format(routeid) if stage.per_route else 'all.json'
+        return os.path.join(self.path_manifest, stage.name, name)
+
+    def stale(self, stage, force=False, skip=()):
+        """
+        :param skip: route ids not to compute (failed in a previous stage)
+        :return: dict {route id: fingerprint} of routes which have to be recomputed
+        """
+        stale = {}
+        for routeid in (self.routeids if stage.per_route else [None]):
+            if routeid in skip:
+                continue
+            fingerprint = self.fingerprint(stage, routeid)
+            if fingerprint is None:
+                print(stage.name, routeid, 'input missing')
+                continue
+            if not force and all(os.path.exists(p) for p in self.outputs(stage, routeid)):
+                try:
+                    with open(self.manifest(stage, routeid)) as f:
+                        if json.load(f)['fingerprint'] == fingerprint:
+                            continue
+                except (OSError, ValueError, KeyError):
+                    pass
+            stale[routeid] = fingerprint
+        return stale
+
+    def run(self, only=None, force=False):
+        """
+        run all stages in order of dependencies, only stale routes are recomputed, routes failed in a stage are skipped
+        by all stages depending on it (a stage over all routes is skipped as a whole)
+        :param only: list of stage names to run (default all)
+        :param force: True to recompute all routes
+        :return: dict {stage name: list of recomputed route ids}
+        """
+        producers = {t: s.name for s in self.stages for t in s.outputs}
+        done, failed = {}, {}
+        for stage in self.stages:
+            if only is not None and stage.name not in only:
+                continue
+            t1 = time.time()
+
+            # routes failed (or skipped) in a stage producing an input of this stage
+            skip = set(r for t in stage.inputs if t in producers for r in failed.get(producers[t], []))
+            if not stage.per_route and len(skip) != 0:
+                skip = {None}
+            if len(skip) != 0:
+                failed[stage.name] = sorted(skip, key=lambda r: -1 if r is None else r)
+                print(stage.name, 'skipped (failed inputs):', failed[stage.name])
+
+            stale = self.stale(stage, force, skip)
+            done[stage.name] = []
+            if len(stale) == 0:
+                print(stage.name, 'up to date')
+                continue
+            for routeid in stale:
+                for p in self.outputs(stage, routeid):
+                    os.makedirs(os.path.dirname(p), exist_ok=True)
+
+            pool = self._pool(stage.graph)
+            results = {r: pool.apply_async(stage.task, (r, self.city, self.path_data), stage.params) for r in stale}
+            for routeid, result in results.items():
+                try:
+                    result.get()
+                except Exception as e:
+                    print(stage.name, routeid, 'failed:', repr(e))
+                    failed.setdefault(stage.name, []).append(routeid)
+                    self._remove_manifest(stage, routeid)
+                    continue
+                self._write_manifest(stage, routeid, stale[routeid])
+                done[stage.name].append(routeid)
+            self.hashes.save()
+            print(stage.name, '{:d}/{:d} recomputed'.format(len(done[stage.name]), len(stale)),
+                  '{:.2f} min'.format((time.time() - t1) / 60))
+        self.close()
+        if len(failed) != 0:
+            raise RuntimeError('pipeline of {:s} failed: {}'.format(self.city, failed))
+        return done
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.close()
+            pool.join()
+        self._pools = {}
+
+    def _pool(self, graph):
+        # one pool with graph (clipping) and one without, graph and routes loaded once per worker
+        if graph not in self._pools:
+            self._pools[graph] = mp.Pool(self.processes, initializer=init_worker,
+                                         initargs=(self.path_graph if graph else None, self.path_routes))
+        return self._pools[graph]
+
+    def _remove_manifest(self, stage, routeid):
+        # outputs of a failed route are not up to date, even if its inputs are unchanged
+        if os.path.exists(self.manifest(stage, routeid)):
+            os.remove(self.manifest(stage, routeid))
+
+    def _write_manifest(self, stage, routeid, fingerprint):
+        path = self.manifest(stage, routeid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(dict(fingerprint=fingerprint, params=stage.params, time=time.time(),
+                           output_hashes=[self.hashes.get(p) for p in self.outputs(stage, routeid)]), f)
+
+
+def order_stages(stages):
+    """
+    topological order of stages (a stage depends on all stages producing one of its inputs)
+    :param stages: list of stages
+    :return: list of stages
+    """
+    producers = {t: s.name for s in stages for t in s.outputs}
+    depends = {s.name: {producers[t] for t in s.inputs if t in producers and producers[t] != s.name} for s in stages}
+    ordered, names = [], set()
+    while len(ordered) < len(stages):
+        ready = [s for s in stages if s.name not in names and depends[s.name] <= names]
+        if len(ready) == 0:
+            raise ValueError('cyclic dependencies between stages')
+        ordered += ready
+        names.update(s.name for s in ready)
+    return ordered
+
+
+class FileHashes():
+    """
+    content hashes of files and folders (graph stores), reused as long as size and modification time are unchanged
+    :param path: json file to store hashes between runs
+    """
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.hashes = json.load(f)
+        except (OSError, ValueError):
+            self.hashes = {}
+
+    def get(self, path):
+        files = [path] if os.path.isfile(path) else \
+            sorted(os.path.join(path, f) for f in os.listdir(path)) if os.path.isdir(path) else []
+        h = hashlib.sha256()
+        for file in files:
+            stat = os.stat(file)
+            cached = self.hashes.get(file)
+            if cached is None or cached[0] != stat.st_size or cached[1] != stat.st_mtime_ns:
+                cached = [stat.st_size, stat.st_mtime_ns, _file_hash(file)]
+                self.hashes[file] = cached
+            h.update(os.path.basename(file).encode())
+            h.update(cached[2].encode())
+        return h.hexdigest()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(self.hashes, f)
+
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
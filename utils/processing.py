@@ -1,42 +1,295 @@
-import momepy as mm
 import time, os
 
 from utils.utils import *
 from utils.area_definitions import *
+from utils.centrality import local_centralities, centrality_cache, write_centrality_cache, read_centrality_cache, \
+    cache_fingerprint
+from utils.workers import worker_graph, worker_routes, worker_compact, worker_centrality_cache
+from utils.graph_store import write_graph, write_subgraphs, write_polygon, read_meta
 
-def local_centrality_computation(routeid, city, path, radius):
+# node ratio thresholds of the area extents (subgraphs are clipped with the threshold of the big area)
+EXTENT_THRESHOLDS = {'big': 1.5, 'medium': 1.346, 'small': 1.203}
+
+def local_centrality_computation(routeid, city, path, radius, path_cache=None):
     t1 = time.time()
 
     # read subgraph
-    g_sub = NetworkGraph(os.path.join(path, 'subgraphs', '{:s}_nx_graph_{:02d}.p'.format(city[3:].lower(), routeid)))
+    g_sub = NetworkGraph(subgraph_path(routeid, city, path, 'subgraphs'))
 
     # CENTRALITY COMPUTATIONS
-    # local closeness centralities
-    g_sub.graph = mm.closeness_centrality(g_sub.graph, radius=radius, distance='length_utm_m',
-                                              weight='length_utm_m', name='cc'+str(radius))
-
-    # local betweenness centralities
-    c_g_sub = nx.MultiGraph(g_sub.keep_only_shortest_edge())  # chosen shortest edge of parallel edges
-    c_g_sub = mm.betweenness_centrality(c_g_sub, radius=radius, distance='length_utm_m',
-                                            weight='length_utm_m', name='cb'+str(radius))
-    for n in g_sub.nodes:
-        try:
-            g_sub.graph.nodes[n]['cb'+str(radius)] = c_g_sub.nodes[n]['cb'+str(radius)]
-        except KeyError:
-            g_sub.graph.nodes[n]['cb'+str(radius)] = float('NaN')
-
-    # local straightness centralities
-    g_sub.graph = mm.straightness_centrality(g_sub.graph, radius=radius, distance='length_utm_m',
-                                                 weight='length_utm_m', name='cs'+str(radius), normalized=False)
+    # local closeness, betweenness and straightness centralities, one bounded dijkstra per node
+    # (with city-wide cache: only nodes near the boundary of the subgraph)
+    cache = read_centrality_cache(path_cache) if path_cache is not None else None
+    centralities = local_centralities(g_sub.compact, radius, cache=cache)
 
     # store modified subgraph
-    path_out = os.path.join(path, 'subgraphs_with_centralities', '{:s}_nx_graph_{:02d}.p'.format(city[3:].lower(), routeid))
-    nx.write_gpickle(g_sub.graph, path_out)
+    store_centralities(g_sub, centralities, subgraph_path(routeid, city, path, 'subgraphs_with_centralities'))
 
     print(routeid, '{:.2f} min'.format((time.time() - t1) / 60))
 
 
-def graph_clipping(routeid, city, graph, routes, path, size):
+def sharded_centrality_computation(routeids, city, path, radius, pool, processes, shards_per_process=4,
+                                   path_cache=None):
+    """
+    local centralities of several subgraphs, source nodes of each subgraph split into shards across the pool:
+    - largest subgraphs dispatched first, number of shards per subgraph according to its number of nodes
+    - partial results of the shards reduced (and stored) as soon as all shards of a subgraph are done
+    :param routeids: list of route ids
+    :param pool: multiprocessing pool
+    :param processes: number of processes of pool
+    :param shards_per_process: approximate number of tasks per process
+    :param path_cache: file of city-wide values (see city_centrality_computation), None to compute all nodes
+    :return:
+    """
+    t1 = time.time()
+    sizes = {r: read_meta(subgraph_path(r, city, path, 'subgraphs'))['nr_nodes'] for r in routeids}
+    shard_size = max(sum(sizes.values()) / (processes * shards_per_process), 1)
+
+    tasks = []
+    for r in sorted(routeids, key=lambda r: sizes[r], reverse=True):
+        shards = int(np.ceil(sizes[r] / shard_size)) if sizes[r] > 0 else 1
+        tasks += [(r, city, path, radius, shard, shards, path_cache) for shard in range(shards)]
+
+    parts = {}
+    for r, shard, shards, centralities in pool.imap_unordered(_centrality_shard, tasks):
+        parts.setdefault(r, []).append(centralities)
+        if len(parts[r]) == shards:
+            g_sub = NetworkGraph(subgraph_path(r, city, path, 'subgraphs'))
+            store_centralities(g_sub, merge_centralities(parts.pop(r)),
+                               subgraph_path(r, city, path, 'subgraphs_with_centralities'))
+            print(r, '{:d} shards'.format(shards), '{:.2f} min'.format((time.time() - t1) / 60))
+
+
+def _centrality_shard(args):
+    # every shards-th node of subgraph as source (mix of central and boundary nodes)
+    routeid, city, path, radius, shard, shards, path_cache = args
+    compact = worker_compact(subgraph_path(routeid, city, path, 'subgraphs'))
+    cache = worker_centrality_cache(path_cache) if path_cache is not None else None
+    return routeid, shard, shards, local_centralities(compact, radius, sources=range(shard, len(compact), shards),
+                                                      cache=cache)
+
+
+def city_centrality_computation(path_graph, radius, path_out, pool, processes, shards_per_process=4):
+    """
+    local centralities of all nodes of the city graph (cached to reuse them for the subgraphs), source nodes split
+    into shards across the pool (city graph loaded once per worker)
+    :param path_graph: path of city graph
+    :param radius: radius [m] or list of radii
+    :param path_out: output file (*.npz)
+    :param pool: multiprocessing pool
+    :param processes: number of processes of pool
+    :param shards_per_process: approximate number of tasks per process
+    :return:
+    """
+    t1 = time.time()
+    shards = processes * shards_per_process
+    parts = pool.map(_city_centrality_shard, [(path_graph, radius, shard, shards) for shard in range(shards)])
+    write_centrality_cache(path_out, NetworkGraph(path_graph, edge_geometries=False).compact, merge_centralities(parts),
+                           cache_fingerprint(path_graph, radius))
+    print('city centralities', '{:.2f} min'.format((time.time() - t1) / 60))
+
+
+def _city_centrality_shard(args):
+    path_graph, radius, shard, shards = args
+    compact = worker_compact(path_graph)
+    return centrality_cache(compact, radius, sources=range(shard, len(compact), shards))
+
+
+def merge_centralities(parts):
+    """
+    reduce partial results of shards (values of nodes not computed by a shard are NaN)
+    :param parts: list of dicts {attribute name: array}
+    :return: dict {attribute name: array}
+    """
+    merged = {a: v.copy() for a, v in parts[0].items()}
+    for part in parts[1:]:
+        for a, v in part.items():
+            computed = ~np.isnan(v)
+            merged[a][computed] = v[computed]
+    return merged
+
+
+def store_centralities(g_sub, centralities, path_out):
+    """
+    add centralities as node attributes and store subgraph
+    :param g_sub: NetworkGraph
+    :param centralities: dict {attribute name: array (nodes in order of graph)}
+    :param path_out: graph store folder (*.graph)
+    :return:
+    """
+    for name, values in centralities.items():
+        for n, value in zip(g_sub.graph, values.tolist()):
+            g_sub.graph.nodes[n][name] = value
+    write_graph(g_sub.graph, path_out)
+
+
+def subgraph_path(routeid, city, path, folder):
+    return os.path.join(path, folder, '{:s}_nx_graph_{:02d}.graph'.format(city[3:].lower(), routeid))
+
+
+def node_ratios_path(routeid, path, oneshot=None):
+    """
+    node ratio table of route: boundingbox/node_ratios (all nodes of the boundingbox graph, two step clipping) or
+    subgraphs/node_ratios (one-shot clipping, only nodes up to the node ratio threshold of the subgraphs)
+    :param oneshot: True / False for the table of the one-shot / two step clipping, None: two step table if present
+    :return: path of csv file
+    """
+    two_step = os.path.join(path, 'boundingbox', 'node_ratios', 'route_{:02d}.csv'.format(routeid))
+    if oneshot is None:
+        oneshot = not os.path.exists(two_step)
+    return os.path.join(path, 'subgraphs', 'node_ratios', 'route_{:02d}.csv'.format(routeid)) if oneshot else two_step
+
+
+def node_lengths(graph, start, end, weight='length_utm_m'):
+    """
+    node length l = shortest path(start - n) + shortest path(n - end) of all nodes in graph,
+    based on one single-source dijkstra out of start and one out of end (on the reversed graph if directed)
+    :param graph: NetworkGraph
+    :param start: node id of route start
+    :param end: node id of route destination
+    :param weight: edge attribute used as edge length
+    :return: dict with node length of all nodes in graph, 0 if start or end is not reachable
+    """
+    g_rev = graph.graph.reverse(copy=False) if graph.graph.is_directed() else graph.graph
+    dist_start = nx.single_source_dijkstra_path_length(graph.graph, start, weight=weight)
+    dist_end = nx.single_source_dijkstra_path_length(g_rev, end, weight=weight)
+
+    l = {}
+    for n in graph.nodes:
+        if n in dist_start and n in dist_end:
+            l[n] = dist_start[n] + dist_end[n]
+        else:
+            l[n] = 0
+    return l
+
+
+def bounded_node_lengths(graph, start, end, max_length, bounds=None):
+    """
+    node length l = shortest path(start - n) + shortest path(n - end) of the nodes with l <= max_length, without
+    searching the whole graph: nodes outside the ellipse d(start, n) + d(n, end) <= max_length (euclidean distance,
+    lower bound of l) are dropped, dijkstra out of start and into end within the ellipse stops at max_length
+    (every node of a path with l <= max_length lies within the ellipse, lengths are exact)
+    :param graph: NetworkGraph
+    :param start: node id of route start
+    :param end: node id of route destination
+    :param max_length: maximum node length [m] (node ratio threshold * shortest path length)
+    :param bounds: (xmin, ymin, xmax, ymax), paths only within this boundingbox (boundary included), e.g. boundingbox
+    graph of the two step clipping, None for the whole graph
+    :return: DataFrame (id, x, y, l) of all nodes reached from start and end (l <= max_length, margin for rounding)
+    """
+    c = graph.compact
+    s, e = c.index[start], c.index[end]
+    limit = max_length * (1 + 1e-9) + 1e-3
+    mask = np.hypot(c.x - c.x[s], c.y - c.y[s]) + np.hypot(c.x - c.x[e], c.y - c.y[e]) <= limit
+    if bounds is not None:
+        mask &= (bounds[0] <= c.x) & (c.x <= bounds[2]) & (bounds[1] <= c.y) & (c.y <= bounds[3])
+
+    dist_start = _bounded_dijkstra(c, s, mask, limit)
+    dist_end = _bounded_dijkstra(c, e, mask, limit, reverse=True)
+    l = dist_start + dist_end
+    ix = np.flatnonzero(l <= limit)
+    return pd.DataFrame({'id': [c.ids[n] for n in ix.tolist()], 'x': c.x[ix], 'y': c.y[ix], 'l': l[ix]})
+
+
+def _bounded_dijkstra(c, source, mask, cutoff, reverse=False):
+    # shortest path lengths (edge length 1 if missing, as networkx) from source (to source if reverse) within nodes
+    # of mask up to cutoff, array (inf if not reached), one CSR matrix of the edges within mask (scipy imported here)
+    import scipy.sparse as sps
+    from scipy.sparse.csgraph import dijkstra
+
+    u, v = (c.edge_v, c.edge_u) if reverse and c.directed else (c.edge_u, c.edge_v)
+    w = np.where(np.isnan(c.length), 1.0, c.length)
+    inside = mask[u] & mask[v] & (u != v)
+    u, v, w = u[inside], v[inside], w[inside]
+    if not c.directed:
+        u, v, w = np.concatenate([u, v]), np.concatenate([v, u]), np.concatenate([w, w])
+
+    # shortest of parallel edges (duplicate entries would be summed), CSR built directly (explicit zeros kept)
+    order = np.lexsort((w, v, u))
+    u, v, w = u[order], v[order], w[order]
+    first = np.concatenate([[True], (u[1:] != u[:-1]) | (v[1:] != v[:-1])]) if len(u) > 0 else np.zeros(0, dtype=bool)
+    u, v, w = u[first], v[first], w[first]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(u, minlength=len(c)))]).astype(np.int64)
+    matrix = sps.csr_matrix((w, v, indptr), shape=(len(c), len(c)))
+    return dijkstra(matrix, directed=True, indices=source, limit=cutoff)
+
+
+def graph_clipping_batch(routeids, city, graph, routes, path, size):
+    """
+    graph clipping of several routes within one task (fewer tasks, graph and routes of the worker reused)
+    :param routeids: list of route ids
+    :param graph: NetworkGraph, None to use the graph loaded once per worker (init_worker)
+    :param routes: routes, None to use the routes loaded once per worker (init_worker)
+    :return:
+    """
+    graph = worker_graph() if graph is None else graph
+    routes = worker_routes() if routes is None else routes
+    for routeid in routeids:
+        graph_clipping(routeid, city, graph, routes, path, size)
+
+
+def graph_clipping_extents(routeid, city, graph, routes, path, extents=None, oneshot=None):
+    """
+    clipping of several area extents of a route in one task (extents are nested threshold cuts of the same node
+    ratio table): node ratios and subgraph with local centralities loaded once, nodes sorted once by node ratio (nodes
+    of an extent are a prefix), extents from the largest to the smallest threshold with the nodes inside the polygon
+    searched among the nodes of the previous extent only, polygon and subgraph of every extent stored as by
+    graph_clipping (same nodes, edges and attributes, in order of the subgraph with local centralities)
+    :param graph: NetworkGraph, None to use the graph loaded once per worker (init_worker)
+    :param routes: routes, None to use the routes loaded once per worker (init_worker)
+    :param extents: dict {area extent: node ratio threshold} (default EXTENT_THRESHOLDS) or list of thresholds
+    (e.g. for a sensitivity analysis, stored as area extent ratio_<threshold>, usable as area extent by
+    streetnetworkproperties.py and regression.py)
+    :param oneshot: node ratio table of one-shot / two step clipping (see node_ratios_path)
+    :return:
+    """
+    t1 = time.time()
+    graph = worker_graph() if graph is None else graph
+    routes = worker_routes() if routes is None else routes
+    extents = EXTENT_THRESHOLDS if extents is None else extents
+    if not isinstance(extents, dict):
+        extents = {'ratio_{:.3f}'.format(thresh): thresh for thresh in extents}
+
+    # shortest path length
+    sp = routes[routeid]
+    sp_length = sum([graph.get_edge_attribute('length_utm_m', edge=i) for i in sp])
+
+    # node ratios and subgraph with local centralities, read once for all extents
+    node_ratios = pd.read_csv(node_ratios_path(routeid, path, oneshot))
+    g = NetworkGraph(subgraph_path(routeid, city, path, 'subgraphs_with_centralities'))
+    index = g.node_index
+
+    # nodes with node ratio <= threshold: prefix of the nodes sorted by node ratio (points of the convex hull in order
+    # of the node ratios table, as area_node_ratios)
+    ratios = (node_ratios.l / sp_length).to_numpy()
+    order = np.flatnonzero(ratios != 0.)
+    order = order[np.argsort(ratios[order], kind='stable')]
+    xy = node_ratios[['x', 'y']].to_numpy(dtype=float)
+
+    inside, nodes, paths = None, [], []
+    for size, thresh in sorted(extents.items(), key=lambda e: e[1], reverse=True):
+        prefix = np.sort(order[:np.searchsorted(ratios[order], thresh, side='right')])
+        g_poly = MultiPoint(xy[prefix]).convex_hull.buffer(1)
+
+        # polygons are nested: nodes of a smaller extent are among the nodes of the previous extent
+        if inside is None:
+            inside = index.query_polygon(g_poly)
+        else:
+            inside = inside[contains_xy(g_poly, index.x[inside], index.y[inside])]
+
+        # store polygon shape
+        os.makedirs(os.path.join(path, size), exist_ok=True)
+        write_polygon(g_poly, os.path.join(path, size, '{:s}_polygon_{:02d}.wkb'.format(city[3:].lower(), routeid)))
+        nodes.append(inside)
+        paths.append(subgraph_path(routeid, city, path, size))
+
+    # clipped subgraphs, columns of the subgraph with local centralities built once for all extents
+    write_subgraphs(g.graph, nodes, paths)
+
+    print(routeid, '{:d} extents'.format(len(extents)), '{:.2f} min'.format((time.time() - t1) / 60))
+
+
+def graph_clipping(routeid, city, graph, routes, path, size, thresh=None, oneshot=None):
     t1 = time.time()
 
     # shortest path, nodes and length
@@ -55,7 +308,7 @@ def graph_clipping(routeid, city, graph, routes, path, size):
 
     elif size == 'subgraphs':
         # subgraphs based on node ratio threshold 1.5, no local centrality attributes present yet
-        thresh = 1.5
+        thresh = EXTENT_THRESHOLDS['big'] if thresh is None else thresh
 
         # use pre-computed csv with node length (for node ratio)
         node_ratios = pd.read_csv(os.path.join(path, 'boundingbox', 'node_ratios', 'route_{:02d}.csv'.format(routeid)))
@@ -65,47 +318,64 @@ def graph_clipping(routeid, city, graph, routes, path, size):
 
     elif size == 'big' or size == 'medium' or size == 'small':
         # subgraphs based on node ratios (BIG, MEDIUM, SMALL AREAS), local centrality attributes have to be added first!
-        thresh = 1.5 if size == 'big' else 1.346 if size == 'medium' else 1.203 if size == 'small' else 0
+        thresh = EXTENT_THRESHOLDS[size] if thresh is None else thresh
 
-        # use pre-computed csv with node length (for node ratio)
-        node_ratios = pd.read_csv(os.path.join(path, 'boundingbox', 'node_ratios', 'route_{:02d}.csv'.format(routeid)))
+        # use pre-computed csv with node length (for node ratio), of two step or one-shot clipping
+        node_ratios = pd.read_csv(node_ratios_path(routeid, path, oneshot))
         g = NetworkGraph(os.path.join(
-            path, 'subgraphs_with_centralities', '{:s}_nx_graph_{:02d}.p'.format(city[3:].lower(), routeid)))
+            path, 'subgraphs_with_centralities', '{:s}_nx_graph_{:02d}.graph'.format(city[3:].lower(), routeid)))
         g_poly, n_spnode = area_node_ratios(g, node_ratios, sp_length, thresh, buffer)
         g_sub = NetworkGraph('', graph=g.graph, nodelist=n_spnode['id'])
 
         # store polygon shape
-        path_out_poly = os.path.join(path, size, '{:s}_polygon_{:02d}.p'.format(city[3:].lower(), routeid))
-        nx.write_gpickle(g_poly, path_out_poly)
+        path_out_poly = os.path.join(path, size, '{:s}_polygon_{:02d}.wkb'.format(city[3:].lower(), routeid))
+        write_polygon(g_poly, path_out_poly)
+
+    elif size == 'subgraphs_oneshot':
+        # boundingbox and subgraphs in one step, same subgraph as the two step clipping: node lengths only of nodes
+        # which can qualify (ellipse within the boundingbox, bounded dijkstra in the city graph), nodes of the area
+        # within the boundingbox, subgraph based on node ratio threshold 1.5 (stored as subgraphs)
+        thresh = EXTENT_THRESHOLDS['big'] if thresh is None else thresh
+        bbox_buffer = sp_length / 2
+        bounds = (min(sp_nodes['x']) - bbox_buffer, min(sp_nodes['y']) - bbox_buffer,
+                  max(sp_nodes['x']) + bbox_buffer, max(sp_nodes['y']) + bbox_buffer)
+        nodeset = bounded_node_lengths(graph, sp_nodes['id'][0], sp_nodes['id'][-1], thresh * sp_length,
+                                       bounds=bounds)
+        _, n_spnode = area_node_ratios(graph, nodeset, sp_length, thresh, buffer)
+        x, y = np.array(n_spnode['x']), np.array(n_spnode['y'])
+        inside = (bounds[0] <= x) & (x <= bounds[2]) & (bounds[1] <= y) & (y <= bounds[3])
+        g_sub = NetworkGraph('', graph=graph.graph, nodelist=[n for n, i in zip(n_spnode['id'], inside) if i])
 
     else:
-        print('Set the variable size to a valid input (boundingbox, subgraphs, big, medium, small).')
+        print('Set the variable size to a valid input (boundingbox, subgraphs, subgraphs_oneshot, big, medium, small).')
         return
 
 
     # store clipped subgraph
-    path_out = os.path.join(path, size, '{:s}_nx_graph_{:02d}.p'.format(city[3:].lower(), routeid))
-    nx.write_gpickle(g_sub.graph, path_out)
+    folder = 'subgraphs' if size == 'subgraphs_oneshot' else size
+    path_out = os.path.join(path, folder, '{:s}_nx_graph_{:02d}.graph'.format(city[3:].lower(), routeid))
+    write_graph(g_sub.graph, path_out)
 
 
     # compute and store node length of all nodes in boundingbox (easier access for later computations)
     if size == 'boundingbox':
         # l = shortest path(start - n) + shortest path(n - end)
+        l = node_lengths(g_sub, sp_nodes['id'][0], sp_nodes['id'][-1])
         nodeset = pd.DataFrame(g_sub.nodes, columns=['id'])
         temp = np.zeros((len(nodeset), 3))
         for n in range(len(nodeset)):
-            try:
-                sp1 = nx.shortest_path_length(g_sub.graph, sp_nodes['id'][0], nodeset.id.iloc[n], weight='length_utm_m')
-                sp2 = nx.shortest_path_length(g_sub.graph, nodeset.id.iloc[n], sp_nodes['id'][-1],
-                                              weight='length_utm_m')
-                l = sp1 + sp2
-            except:
-                l = 0
             pt = g_sub.nodes[nodeset.id.iloc[n]]['geom_utm']
-            temp[n, :] = np.array([pt.x, pt.y, l])
+            temp[n, :] = np.array([pt.x, pt.y, l[nodeset.id.iloc[n]]])
         nodeset = pd.concat([nodeset, pd.DataFrame(temp, columns=['x', 'y', 'l'])], axis=1)
 
         save_path = os.path.join(path, size, 'node_ratios', 'route_{:02d}.csv'.format(routeid))
         nodeset.to_csv(save_path, index=False)
 
+    # node lengths of the one-shot clipping (nodes with l <= threshold * shortest path length only, own table, the
+    # table of all boundingbox nodes is needed by taken_nodes.py)
+    if size == 'subgraphs_oneshot':
+        save_path = node_ratios_path(routeid, path, oneshot=True)
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        nodeset.to_csv(save_path, index=False)
+
     print(routeid, '{:.2f} min'.format((time.time() - t1) / 60))
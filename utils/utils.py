@@ -1,18 +1,156 @@
+import os
+import ast
+import copy
+import json
 import networkx as nx
 import pandas as pd
 import numpy as np
-from shapely.geometry import Point
+try:
+    from shapely import contains_xy
+except ImportError:  # shapely < 2.0
+    from shapely.vectorized import contains as contains_xy
+
+from utils.compact import CompactGraph
+from utils.bearing import incidence_bearings
+from utils.graph_store import is_graph_store, read_graph, legacy_path
+
+
+class NodeIndex():
+    """
+    spatial index of node coordinates (packed x/y arrays and uniform grid), nodes in order of graph
+    """
+    def __init__(self, graph, nodes_per_cell=16):
+        self.ids = list(graph)
+        self.x = np.array([graph.nodes[n]['geom_utm'].x for n in self.ids], dtype=np.float64)
+        self.y = np.array([graph.nodes[n]['geom_utm'].y for n in self.ids], dtype=np.float64)
+
+        # uniform grid, cells numbered row by row (cell = row * nx + column)
+        if len(self.ids) != 0:
+            self.x0, self.y0 = self.x.min(), self.y.min()
+            extent = max(self.x.max() - self.x0, self.y.max() - self.y0)
+            self.cell_size = max(extent / np.sqrt(len(self.ids) / nodes_per_cell), 1.0)
+        else:
+            self.x0, self.y0, self.cell_size = 0.0, 0.0, 1.0
+        self.nx = int((self.x.max() - self.x0) // self.cell_size) + 1 if len(self.ids) != 0 else 1
+        self.ny = int((self.y.max() - self.y0) // self.cell_size) + 1 if len(self.ids) != 0 else 1
+        cells = self._row(self.y) * self.nx + self._col(self.x)
+        self.order = np.argsort(cells, kind='stable')
+        self.cell_start = np.searchsorted(cells[self.order], np.arange(self.nx * self.ny + 1))
+        self._id_order, self._sorted_ids = None, None
+
+    def _col(self, x):
+        return np.clip(((np.asarray(x) - self.x0) // self.cell_size).astype(np.int64), 0, self.nx - 1)
+
+    def _row(self, y):
+        return np.clip(((np.asarray(y) - self.y0) // self.cell_size).astype(np.int64), 0, self.ny - 1)
+
+    def query_bbox(self, xmin, ymin, xmax, ymax):
+        """
+        :return: indices of nodes inside bounding box (boundary included), in order of graph
+        """
+        if len(self.ids) == 0 or xmax < self.x0 or ymax < self.y0:
+            return np.zeros(0, dtype=np.int64)
+        c0, c1 = self._col(xmin), self._col(xmax)
+        candidates = [self.order[self.cell_start[r * self.nx + c0]:self.cell_start[r * self.nx + c1 + 1]]
+                      for r in range(self._row(ymin), self._row(ymax) + 1)]
+        ix = np.sort(np.concatenate(candidates))
+        inside = (xmin <= self.x[ix]) & (self.x[ix] <= xmax) & (ymin <= self.y[ix]) & (self.y[ix] <= ymax)
+        return ix[inside]
+
+    def query_polygon(self, polygon):
+        """
+        :return: indices of nodes inside polygon (boundary excluded), in order of graph
+        """
+        if polygon.is_empty:
+            return np.zeros(0, dtype=np.int64)
+        ix = self.query_bbox(*polygon.bounds)
+        return ix[contains_xy(polygon, self.x[ix], self.y[ix])]
+
+    def to_dict(self, ix):
+        return dict(id=[self.ids[i] for i in ix], x=self.x[ix].tolist(), y=self.y[ix].tolist())
+
+    def lookup(self, ids):
+        """
+        :param ids: array of node ids
+        :return: indices of nodes, -1 if node is not in graph
+        """
+        if self._sorted_ids is None:
+            self._id_order = np.argsort(np.asarray(self.ids), kind='stable')
+            self._sorted_ids = np.asarray(self.ids)[self._id_order]
+        ids = np.asarray(ids)
+        pos = np.clip(np.searchsorted(self._sorted_ids, ids), 0, max(len(self.ids) - 1, 0))
+        found = self._sorted_ids[pos] == ids if len(self.ids) != 0 else np.zeros(len(ids), dtype=bool)
+        return np.where(found, self._id_order[pos] if len(self.ids) != 0 else -1, -1)
+
 
 class NetworkGraph():
-    def __init__(self, path, graph=None, nodelist=None):
+    def __init__(self, path, graph=None, nodelist=None, edge_geometries=True):
+        # edge_geometries: False to read a graph store without edge geometries (e.g. only node coordinates, edge
+        # lengths or CSR adjacency needed), pickled graphs always contain them
         if graph and nodelist is None:
             self.graph = graph
         elif graph and nodelist is not None:
             self.graph = graph.subgraph(nodelist).copy()
+        elif is_graph_store(path):
+            self.graph = read_graph(path, edge_geometries=edge_geometries)
         else:
-            self.graph = nx.read_gpickle(path)
+            # pickled graph (also instead of a missing graph store, see legacy_path)
+            self.graph = nx.read_gpickle(legacy_path(path))
         self.nodes = self.graph.nodes
         self.edges = self.graph.edges
+        self._node_index = None
+        self._compact = None
+        self._incidence_bearings = None
+
+    @property
+    def compact(self):
+        # array representation of graph (CompactGraph), built once at first use
+        if self._compact is None:
+            self._compact = CompactGraph(self.graph)
+        return self._compact
+
+    def reset_cache(self):
+        # array representations have to be rebuilt after nodes, edges or attributes of the graph changed
+        self._node_index = None
+        self._compact = None
+        self._incidence_bearings = None
+
+    @property
+    def incidence_bearings(self):
+        # bearing of all node-edge incidences (node index, adjacent node index, bearing), built once at first use
+        if self._incidence_bearings is None:
+            self._incidence_bearings = incidence_bearings(self)
+        return self._incidence_bearings
+
+    def subgraph(self, mask):
+        """
+        induced subgraph as view of this graph (no copy), arrays (compact graph, incidence bearings) taken from this
+        graph instead of being rebuilt
+        :param mask: boolean array (one value per node in order of compact graph)
+        :return: NetworkGraph
+        """
+        mask = np.asarray(mask, dtype=bool)
+        c = self.compact
+        sub = copy.copy(self)
+        sub.graph = self.graph.subgraph([n for n, m in zip(c.ids, mask.tolist()) if m])
+        sub.nodes = sub.graph.nodes
+        sub.edges = sub.graph.edges
+        sub._node_index = None
+        sub._compact = c.subgraph(mask)
+
+        # incidences with both nodes in subgraph
+        node, adj, bearing = self.incidence_bearings
+        new_index = np.cumsum(mask) - 1
+        keep = mask[node] & mask[adj]
+        sub._incidence_bearings = new_index[node[keep]], new_index[adj[keep]], bearing[keep]
+        return sub
+
+    @property
+    def node_index(self):
+        # spatial index of node coordinates, built once at first use
+        if self._node_index is None:
+            self._node_index = NodeIndex(self.graph)
+        return self._node_index
 
     def get_node_attributes(self):
         pass
@@ -74,14 +212,12 @@ class NetworkGraph():
         return dict(id=nodes, x=x, y=y)
 
     def get_nodes_in_polygon(self, polygon):
-        nodes_inside = dict(id=[], x=[], y=[])
-        for n in self.graph:
-            pt = self.nodes[n]['geom_utm']
-            if polygon.contains(Point(pt.x, pt.y)):
-                nodes_inside['id'].append(n)
-                nodes_inside['x'].append(pt.x)
-                nodes_inside['y'].append(pt.y)
-        return nodes_inside
+        ix = self.node_index.query_polygon(polygon)
+        return self.node_index.to_dict(ix)
+
+    def get_nodes_in_bbox(self, xmin, ymin, xmax, ymax):
+        ix = self.node_index.query_bbox(xmin, ymin, xmax, ymax)
+        return self.node_index.to_dict(ix)
 
     def plot(self):
         # unfreeze graph  returns a MultiGraph, but without selfloops (JUST FOR PLOTTING)
@@ -102,15 +238,89 @@ class NetworkGraph():
         return g_single
 
 class AgentData():
-    def __init__(self, path, fields=None):
+    def __init__(self, path, fields=None, cache=None):
+        """
+        simulation results, edge lists of path_taken_edges parsed once into flat arrays:
+        edges of row i are self.edges[self.offsets[i]:self.offsets[i+1]] (one row per edge, e.g. u, v, key)
+        :param path: csv file or folder with arrays (see dump)
+        :param fields: columns of csv file to use
+        :param cache: folder of binary sidecars (parsed csv stored in / loaded from cache/<csv file name>), None to
+        parse the csv without sidecar (input folders, e.g. 01_Original, are never written to)
+        """
+        self.edges, self.offsets = None, None
+        self.cache_path = None
+
+        if os.path.isdir(path):
+            self._load(path)
+        else:
+            self._read(path, fields, cache)
+
+        # rows sorted by (route_id, agent_id), index of routes and agents
+        self._build_index()
+
+    def _read(self, path, fields, cache):
         if fields is None:
             fields = ['agent_id', 'route_id', 'path_taken_edges',
                       'shortest_path_length', 'path_taken_length', 'goal_reached']
+
+        # parsed csv of previous run (sidecar), skips csv parsing
+        if cache is not None:
+            self.cache_path = os.path.join(cache, os.path.basename(path))
+        source = dict(size=os.path.getsize(path), mtime=os.path.getmtime(path), fields=sorted(fields))
+        if cache is not None and os.path.exists(os.path.join(self.cache_path, 'source.json')):
+            with open(os.path.join(self.cache_path, 'source.json')) as f:
+                if json.load(f) == source:
+                    self._load(self.cache_path)
+                    return
+
         self.data = pd.read_csv(path, usecols=fields)
+        if 'path_taken_edges' in self.data:
+            self.edges, self.offsets = parse_edge_lists(self.data.pop('path_taken_edges'))
         self.data['taken_shortest'] = self.data['path_taken_length'] / self.data['shortest_path_length']
         conditions = [(self.data['goal_reached'] == 1) & (self.data['taken_shortest'] <= 1.50),
                       (self.data['goal_reached'] == 0), (self.data['taken_shortest'] > 1.50)]
         self.data['success'] = np.select(conditions, [True, False, False])
+        self._sort()
+
+        if cache is not None:
+            self.dump(self.cache_path)
+            with open(os.path.join(self.cache_path, 'source.json'), 'w') as f:
+                json.dump(source, f)
+
+    def _sort(self):
+        # stable sort of rows (and edge lists) by (route_id, agent_id)
+        order = np.lexsort((self.data.agent_id.to_numpy(), self.data.route_id.to_numpy()))
+        if np.array_equal(order, np.arange(len(order))):
+            return
+        self.data = self.data.take(order).reset_index(drop=True)
+        if self.edges is not None:
+            counts = np.diff(self.offsets)[order]
+            offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+            ix = np.repeat(self.offsets[:-1][order] - offsets[:-1], counts) + np.arange(offsets[-1])
+            self.edges, self.offsets = self.edges[ix], offsets
+
+    def _build_index(self):
+        self._sort()
+        self._route, self._agent = self.data.route_id.to_numpy(), self.data.agent_id.to_numpy()
+
+        # route groups: rows route_start[i]:route_end[i] (sorted by agent_id)
+        self._route_ids, self._route_start = np.unique(self._route, return_index=True)
+        self._route_end = np.append(self._route_start[1:], len(self._route))
+
+        # agent groups: rows agent_order[agent_start[i]:agent_end[i]] (sorted by route_id)
+        self._agent_order = np.lexsort((self._route, self._agent))
+        self._agent_ids, self._agent_start = np.unique(self._agent[self._agent_order], return_index=True)
+        self._agent_end = np.append(self._agent_start[1:], len(self._agent))
+
+    def _load(self, path):
+        # columns stored as numpy arrays (see dump), read into memory (pandas copies them into its blocks, strings
+        # into object columns), edge lists memory-mapped (bulk of the data)
+        with open(os.path.join(path, 'columns.json')) as f:
+            columns = json.load(f)
+        self.data = pd.DataFrame({c: np.load(os.path.join(path, c + '.npy')) for c in columns}, columns=columns)
+        if os.path.exists(os.path.join(path, 'edges.npy')):
+            self.edges = np.load(os.path.join(path, 'edges.npy'), mmap_mode='r')
+            self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
 
     def success_per_route(self, id=None):
         if id is not None:
@@ -122,11 +332,136 @@ class AgentData():
         success['percentage'] = success['count'] / 3000 * 100
         return success
 
+    def dump(self, path):
+        """
+        store all columns and parsed edge lists as numpy arrays (strings as fixed-width unicode),
+        edge lists to be memory-mapped by AgentData(path)
+        :param path: output folder
+        :return:
+        """
+        os.makedirs(path, exist_ok=True)
+        if self.edges is not None:
+            np.save(os.path.join(path, 'edges.npy'), self.edges)
+            np.save(os.path.join(path, 'offsets.npy'), self.offsets)
+        for c in self.data.columns:
+            values = self.data[c].to_numpy()
+            if values.dtype == object:
+                values = values.astype(str)
+            np.save(os.path.join(path, c + '.npy'), values)
+        with open(os.path.join(path, 'columns.json'), 'w') as f:
+            json.dump(list(self.data.columns), f)
+
+    def route_rows(self, route):
+        """
+        :return: first and last+1 row of route (rows sorted by agent_id)
+        """
+        i = np.searchsorted(self._route_ids, route)
+        if i == len(self._route_ids) or self._route_ids[i] != route:
+            return 0, 0
+        return self._route_start[i], self._route_end[i]
+
+    def agent_rows(self, agent):
+        """
+        :return: rows of agent (sorted by route_id)
+        """
+        i = np.searchsorted(self._agent_ids, agent)
+        if i == len(self._agent_ids) or self._agent_ids[i] != agent:
+            return self._agent_order[:0]
+        return self._agent_order[self._agent_start[i]:self._agent_end[i]]
+
+    def get_row(self, agent, route):
+        """
+        :return: row of agent on route, -1 if not in data
+        """
+        start, end = self.route_rows(route)
+        i = start + np.searchsorted(self._agent[start:end], agent)
+        return i if i < end and self._agent[i] == agent else -1
+
     def get_filtered_data(self, agent=None, route=None):
         if agent is None and route is None:
             return None
         if agent is None:
-            return self.data[(self.data.route_id == route)].reset_index(drop=True)
+            start, end = self.route_rows(route)
+            return self.data.iloc[start:end].reset_index(drop=True)
         if route is None:
-            return self.data[(self.data.agent_id == agent)].reset_index(drop=True)
-        return self.data[(self.data.route_id == route) & (self.data.agent_id == agent)].reset_index(drop=True)
\ No newline at end of file
+            return self.data.iloc[self.agent_rows(agent)].reset_index(drop=True)
+        row = self.get_row(agent, route)
+        return self.data.iloc[row:row + 1 if row != -1 else 0].reset_index(drop=True)
+
+    def get_path_edges(self, agent, route):
+        """
+        :return: taken edges of agent on route, list of tuples (e.g. (u, v, key))
+        """
+        row = self.get_row(agent, route)
+        if row == -1:
+            raise KeyError('agent {} not in data of route {}'.format(agent, route))
+        return [tuple(e) for e in self.edges[self.offsets[row]:self.offsets[row + 1]].tolist()]
+
+    def get_route_path_edges(self, route):
+        """
+        :return: taken edges of all agents on route (sorted by agent_id), list of lists of tuples
+        """
+        return [[tuple(e) for e in edges.tolist()] for _, _, edges in self.iter_route(route)]
+
+    def route_nodes(self, route):
+        """
+        nodes of all trajectories of route in one array (same nodes as NetworkGraph.get_nodes_of_route per trajectory)
+        :return: row of each node (sorted by agent_id), node ids
+        """
+        start, end = self.route_rows(route)
+        offsets = np.asarray(self.offsets[start:end + 1])
+        edges = np.asarray(self.edges[offsets[0]:offsets[-1]])
+        counts = np.diff(offsets)
+
+        # first node of every edge, last node added after every edge equal to the last edge of its trajectory
+        last = edges[np.repeat(offsets[1:] - offsets[0] - 1, counts)]
+        is_last = (edges == last).all(axis=1)
+        pos = np.arange(len(edges)) + np.concatenate([[0], np.cumsum(is_last)[:-1]]).astype(np.int64)
+        nodes = np.empty(len(edges) + np.count_nonzero(is_last), dtype=edges.dtype)
+        nodes[pos] = edges[:, 0]
+        nodes[pos[is_last] + 1] = edges[is_last, 1]
+        rows = np.empty(len(nodes), dtype=np.int64)
+        rows[pos] = np.repeat(np.arange(start, end), counts)
+        rows[pos[is_last] + 1] = rows[pos[is_last]]
+        return rows, nodes
+
+    def iter_route(self, route):
+        """
+        iterator over all trajectories of route (sorted by agent_id), no copies of data
+        :return: agent_id, success, taken edges (view of edge array, one row per edge)
+        """
+        start, end = self.route_rows(route)
+        success = self.data.success.to_numpy()
+        for r in range(start, end):
+            yield self._agent[r], success[r], self.edges[self.offsets[r]:self.offsets[r + 1]]
+
+
+def parse_edge_lists(strings):
+    """
+    safe parser of string-encoded edge lists (e.g. '[(1, 2, 0), (2, 3, 0)]'), without eval
+    :param strings: pandas Series of strings
+    :return: edges (int array, one row per edge), offsets (edges of string i are edges[offsets[i]:offsets[i+1]])
+    """
+    strings = strings.astype(str)
+    counts = strings.str.count(r'\(').to_numpy()
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    try:
+        # all numbers in one pass (brackets and commas as separators), every tuple has to contain width integers
+        numbers = np.array(' '.join(strings).translate(_separators).split(), dtype=np.int64)
+        width = len(numbers) // offsets[-1] if offsets[-1] != 0 else 3
+        tuples = r'\(\s*-?\d+\s*(?:,\s*-?\d+\s*){%d},?\s*\)' % (width - 1)
+        if len(numbers) != width * offsets[-1] or not np.array_equal(strings.str.count(tuples).to_numpy(), counts):
+            raise ValueError
+    except ValueError:
+        # fallback: literal parsing per string (still no eval), e.g. lists instead of tuples
+        rows = [ast.literal_eval(st) for st in strings]
+        widths = {len(e) for r in rows for e in r}
+        if len(widths) > 1:
+            raise ValueError('edges of path_taken_edges with different numbers of values: {}'.format(sorted(widths)))
+        width = widths.pop() if len(widths) != 0 else 3
+        offsets = np.concatenate([[0], np.cumsum([len(r) for r in rows])]).astype(np.int64)
+        numbers = np.array([n for r in rows for e in r for n in e], dtype=np.int64)
+    return numbers.reshape(-1, width), offsets
+
+
+_separators = str.maketrans('[](),', '     ')
@@ -0,0 +1,62 @@
+import networkx as nx
+
+from utils.utils import *
+from utils.centrality import read_centrality_cache
+
+# data of the current worker process, loaded once per worker (see init_worker)
+_worker = dict(graph=None, routes=None, data={}, compact={}, centrality_cache={})
+
+
+def init_worker(path_graph=None, path_routes=None, paths_data=None, edge_geometries=True):
+    """
+    initializer of multiprocessing pools, loads graph, routes and agent data once per worker
+    (tasks only carry route ids instead of the whole graph / data)
+    :param path_graph: path of graph (NetworkGraph)
+    :param path_routes: path of routes
+    :param paths_data: dict {file name: folder with AgentData arrays, edge lists memory-mapped (see AgentData.dump)}
+    :param edge_geometries: False to load the graph without edge geometries (see NetworkGraph)
+    :return:
+    """
+    if path_graph is not None:
+        _worker['graph'] = NetworkGraph(path_graph, edge_geometries=edge_geometries)
+    if path_routes is not None:
+        _worker['routes'] = nx.read_gpickle(path_routes)
+    if paths_data is not None:
+        _worker['data'] = {f: AgentData(p) for f, p in paths_data.items()}
+
+
+def worker_graph():
+    return _worker['graph']
+
+
+def worker_routes():
+    return _worker['routes']
+
+
+def worker_data(file):
+    return _worker['data'][file]
+
+
+def worker_compact(path):
+    """
+    compact graph of (sub)graph, the last loaded graphs are kept by the worker
+    (consecutive tasks of the same graph, e.g. centrality shards)
+    :param path: graph store folder (*.graph) or pickled graph
+    :return: CompactGraph
+    """
+    if path not in _worker['compact']:
+        if len(_worker['compact']) >= 2:
+            del _worker['compact'][next(iter(_worker['compact']))]
+        graph = read_graph(path, edge_geometries=False) if is_graph_store(path) else NetworkGraph(path).graph
+        _worker['compact'][path] = CompactGraph(graph)
+    return _worker['compact'][path]
+
+
+def worker_centrality_cache(path):
+    """
+    :param path: file of city-wide local centralities (see utils.centrality.write_centrality_cache)
+    :return: cache, loaded once per worker
+    """
+    if path not in _worker['centrality_cache']:
+        _worker['centrality_cache'] = {path: read_centrality_cache(path)}
+    return _worker['centrality_cache'][path]